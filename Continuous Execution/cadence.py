@@ -0,0 +1,86 @@
+### Adaptive polling cadence for the hourly checks.
+# Instead of querying every unit each hour, the check runs every POLL_MINUTES and only queries the units that are due:
+#   - units that were offline / partial / error within the last UNSTABLE_HOURS (or have no history) every POLL_MINUTES
+#   - units that have been online since then every BASE_INTERVAL_MINUTES, doubling for every STABLE_DAYS
+#     they stay online, up to MAX_INTERVAL_MINUTES
+# Stability comes from the status history written by StoreStatus (see status_store), the same data checkUnitStatus
+# compares against. Units that are not due are reported from their last result in sweep_cache.
+#
+# At most BUDGET_PER_HOUR gateways are queried in any rolling hour. When more are due, units never queried come first,
+# then unstable units, then the most overdue ones. Units without any earlier result are always queried.
+import collections
+import threading
+
+import run_log
+import status_store
+import sweep_cache
+
+log = run_log.get_logger("cadence")
+
+# Check intervals and request budget of ADAPTIVE_POLLING (POLL_* rows)
+POLL_MINUTES                = 15            # Check interval, and the interval of unstable units
+MAX_INTERVAL_MINUTES        = 240           # Longest interval of a stable unit
+BUDGET_PER_HOUR             = 0             # Max gateways queried per rolling hour, 0 for no limit
+BASE_INTERVAL_MINUTES       = 60            # Interval of a unit that is stable but not for long
+UNSTABLE_HOURS              = 6             # A unit not online within this window is polled every POLL_MINUTES
+STABLE_DAYS                 = 7             # The interval doubles for every STABLE_DAYS online
+
+_polls = collections.deque()                # epoch ms of every gateway query made in the last hour
+_lock = threading.Lock()
+
+
+def configure(poll_minutes=POLL_MINUTES, max_interval_minutes=MAX_INTERVAL_MINUTES, budget_per_hour=BUDGET_PER_HOUR):
+    global POLL_MINUTES, MAX_INTERVAL_MINUTES, BUDGET_PER_HOUR
+    POLL_MINUTES = int(poll_minutes)
+    MAX_INTERVAL_MINUTES = int(max_interval_minutes)
+    BUDGET_PER_HOUR = int(budget_per_hour)
+
+
+# Minutes between two queries of a unit, from (last not online run_at, first run_at) in epoch ms.
+def get_interval(stability, now):
+    last_unstable, first_seen = stability
+    if first_seen is None or (last_unstable is not None and now - last_unstable < UNSTABLE_HOURS * 60 * 60 * 1000):
+        return POLL_MINUTES
+    stable_days = (now - (last_unstable or first_seen)) / (24 * 60 * 60 * 1000)
+    return max(POLL_MINUTES, min(MAX_INTERVAL_MINUTES, BASE_INTERVAL_MINUTES * 2 ** int(stable_days // STABLE_DAYS)))
+
+
+# Returns the set of gateway ids to query now, units is {gateway id: (unit name, loc, remarks)} and now is in epoch ms.
+# The queries only count against the budget once made, see record_polls.
+def plan(units, now):
+    stability = status_store.get_unit_stability([values[0] for values in units.values()])
+    slack = POLL_MINUTES / 2                # Runs start a little after their slot, do not miss a unit by seconds
+    candidates = []                         # (priority, -overdue ratio, gateway id)
+    for key, values in units.items():
+        interval = get_interval(stability[values[0]], now)
+        entry = sweep_cache.get(key, now, max_age=float("inf"))
+        if entry is None:
+            candidates.append((0, 0, key))
+            continue
+        age = (now - entry[0]) / 60000
+        if age >= interval - slack:
+            candidates.append((1 if interval <= POLL_MINUTES else 2, -age / interval, key))
+    candidates.sort()
+
+    with _lock:
+        while _polls and now - _polls[0] >= 60 * 60 * 1000:
+            _polls.popleft()
+        if BUDGET_PER_HOUR > 0:
+            allowed = max(BUDGET_PER_HOUR - len(_polls), sum(1 for candidate in candidates if candidate[0] == 0))
+        else:
+            allowed = len(candidates)
+        due = [candidate[2] for candidate in candidates[:allowed]]
+        used = len(_polls) + len(due)
+
+    log.info(
+        "Adaptive polling: " + str(len(candidates)) + " of " + str(len(units)) + " units due, querying "
+        + str(len(due)) + ", " + str(len(candidates) - len(due)) + " deferred by the request budget ("
+        + str(used) + " queries in the last hour" + (" of " + str(BUDGET_PER_HOUR) if BUDGET_PER_HOUR > 0 else "") + ")."
+    )
+    return set(due)
+
+
+# Counts queries made at now (epoch ms) against the budget. Due units cancelled at the run deadline are not counted.
+def record_polls(count, now):
+    with _lock:
+        _polls.extend([now] * count)
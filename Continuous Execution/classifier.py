@@ -0,0 +1,61 @@
+### Logic V2 classification of the whole fleet in one pass.
+# The fetch results are gathered into columns (one entry per unit) and every unit is classified with numpy array
+# operations instead of nested ifs per unit. Thresholds can differ per unit. No network or config access here,
+# so the combination table can be checked with plain arrays.
+#
+#   platform \ Dataplicity | online                                  | offline
+#   online   (WITHIN_HOURS) | remarks                                 | remarks + disconnected from dataplicity
+#   partial  (WITHIN_DAYS)  | remarks + data lag                      | remarks + disconnected and data lag
+#   offline  (no logs)      | "No logs data ... IoT disconnection."   | remarks
+import numpy as np
+
+ONLINE, PARTIAL, OFFLINE = 0, 1, 2
+STATUS_NAMES = ("online", "partial", "offline")
+
+# Remark suffix per (platform status, Dataplicity offline)
+_SUFFIXES = (
+    ("", "\nDevice is disconnected from dataplicity."),
+    ("\nDevice is experiencing data lag.", "\nDevice is disconnected from dataplicity and experiencing data lag?"),
+    (None, ""),                             # None: remarks are replaced, see _get_offline_remark
+)
+
+
+def _get_offline_remark(within_days):
+    return "No logs data in the last " + str(within_days) + " days. IoT disconnection."
+
+
+# Columns, all of the same length:
+#   last_timestamp      epoch seconds of the newest record, nan when there are no logs in the window
+#   fetched_at          epoch ms when the unit's logs were fetched
+#   dataplicity_offline True when Dataplicity reports the unit offline
+#   within_hours        hours without data before a unit is no longer online, scalar or per unit
+# Returns (status codes, latency in ms of the newest record or nan when there are no logs, remark suffix codes).
+def classify(last_timestamp, fetched_at, dataplicity_offline, within_hours):
+    last_timestamp = np.asarray(last_timestamp, dtype=np.float64)
+    fetched_at = np.asarray(fetched_at, dtype=np.int64)
+    dataplicity_offline = np.asarray(dataplicity_offline, dtype=bool)
+    within_hours = np.asarray(within_hours, dtype=np.float64)
+
+    has_logs = ~np.isnan(last_timestamp)
+    online_from = fetched_at - within_hours * 60 * 60 * 1000
+    with np.errstate(invalid="ignore"):
+        recent = has_logs & (last_timestamp * 1000 >= online_from)
+    status = np.where(recent, ONLINE, np.where(has_logs, PARTIAL, OFFLINE))
+
+    latency = np.full(len(last_timestamp), np.nan)
+    latency[has_logs] = fetched_at[has_logs] - (last_timestamp[has_logs] * 1000).astype(np.int64)
+    return status, latency, status * 2 + dataplicity_offline
+
+
+# Applies classify() and builds the remarks, returns a list of (status name, remarks, latency in ms or None).
+# remarks is the list of the units' own remarks, within_days (days of the fetch window) is a scalar or a list per unit.
+def classify_units(last_timestamp, fetched_at, dataplicity_offline, remarks, within_hours, within_days):
+    status, latency, combination = classify(last_timestamp, fetched_at, dataplicity_offline, within_hours)
+    if np.ndim(within_days) == 0:
+        within_days = [within_days] * len(remarks)
+    results = []
+    for code, lag, combo, remark, days in zip(status.tolist(), latency.tolist(), combination.tolist(), remarks, within_days):
+        suffix = _SUFFIXES[combo // 2][combo % 2]
+        remark = _get_offline_remark(days) if suffix is None else remark + suffix
+        results.append((STATUS_NAMES[code], remark, None if lag != lag else int(lag)))
+    return results
@@ -0,0 +1,240 @@
+### Config workbook loader.
+# Each workbook (vft_config.xlsx / mads_config.xlsx) is parsed in one pass into a PlatformConfig.
+# The parsed config is kept in memory and only re-parsed when the file on disk changes.
+#
+# compile_config() also writes the parsed config to a JSON snapshot next to the workbook (vft_config.snapshot.json).
+# On a cold start the snapshot is loaded without importing pandas/openpyxl; the workbook is only parsed
+# (and the snapshot rewritten) when the snapshot is missing or older than the workbook.
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+
+import run_log
+
+log = run_log.get_logger("config")
+
+SNAPSHOT_SUFFIX             = ".snapshot.json"
+SNAPSHOT_VERSION            = 1
+UNITS_SHEET_SUFFIX          = "units_sheet"
+DATA_SHEET                  = "data_sheet"
+ACCOUNT_SHEET               = "account_sheet"
+EMAIL_SHEET                 = "email_sheet"
+
+
+@dataclass
+class PlatformConfig:
+    # account_sheet, dicts where keys are email and password
+    account_login: dict
+    dataplicity_login: dict
+    # data_sheet
+    within_hours: int
+    within_days: int
+    logs_display_page_size: int
+    logs_display_page_number: int
+    # email_sheet
+    smtp_server: str
+    port: int
+    sender_email: str
+    email_api_key: str
+    recipients_iot_team: list
+    recipients_everyone: list
+    # key: units sheet name, value: {unit id: (unit name, location, remarks)}
+    units: dict = field(default_factory=dict)
+    # key: units sheet name, value: {unit id: (within hours, within days)} from the optional WITHIN_HOURS / WITHIN_DAYS
+    # columns, None where the cell is empty. Units without either value are left out.
+    unit_thresholds: dict = field(default_factory=dict)
+    # Every "NAME | value" row of data_sheet / email_sheet, used for optional fields
+    data_fields: dict = field(default_factory=dict)
+    email_fields: dict = field(default_factory=dict)
+
+
+_cache = {}                                 # key: path, value: (mtime_ns, size, sha1, PlatformConfig)
+
+
+# Returns the PlatformConfig for path, parsing the workbook only if it changed since the last call.
+# A changed mtime alone (e.g. the file was copied over with the same content) is confirmed with a hash first.
+def load_config(path):
+    if not os.path.exists(path) and os.path.exists(get_snapshot_path(path)):
+        # Deployed with the compiled snapshot only
+        if path not in _cache:
+            _cache[path] = (None, None, None, read_snapshot(get_snapshot_path(path))[1])
+        return _cache[path][3]
+
+    stat = os.stat(path)
+    cached = _cache.get(path)
+    if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+        return cached[3]
+
+    digest = get_file_hash(path)
+    if cached and cached[2] == digest:
+        _cache[path] = (stat.st_mtime_ns, stat.st_size, digest, cached[3])
+        return cached[3]
+
+    config = load_snapshot(path, stat, digest)
+    if config is None:
+        log.info("Reading configuration from " + path)
+        config = compile_config(path)
+    _cache[path] = (stat.st_mtime_ns, stat.st_size, digest, config)
+    return config
+
+
+def get_snapshot_path(path):
+    return os.path.splitext(path)[0] + SNAPSHOT_SUFFIX
+
+
+# Parse the workbook and write its snapshot, returns the parsed PlatformConfig.
+def compile_config(path):
+    config = parse_workbook(path)
+    stat = os.stat(path)
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "source": {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha1": get_file_hash(path)},
+        "config": asdict(config),
+    }
+    # JSON object keys must be strings, store units as [id, name, location, remarks] rows to keep the id type and order
+    for name in ("units", "unit_thresholds"):
+        snapshot["config"][name] = {
+            sheet_name: [[key] + list(values) for key, values in units.items()]
+            for sheet_name, units in getattr(config, name).items()
+        }
+    snapshot_path = get_snapshot_path(path)
+    temp_file = snapshot_path + ".tmp"
+    with open(temp_file, "w") as outfile:
+        json.dump(snapshot, outfile, separators=(",", ":"))
+    os.replace(temp_file, snapshot_path)
+    return config
+
+
+# Returns (source, PlatformConfig) from a snapshot file.
+def read_snapshot(snapshot_path):
+    with open(snapshot_path) as infile:
+        snapshot = json.load(infile)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("Unsupported snapshot version in " + snapshot_path)
+    fields = snapshot["config"]
+    for name in ("units", "unit_thresholds"):
+        fields[name] = {
+            sheet_name: {row[0]: tuple(row[1:]) for row in rows}
+            for sheet_name, rows in fields.get(name, {}).items()
+        }
+    return snapshot["source"], PlatformConfig(**fields)
+
+
+# Returns the snapshot's PlatformConfig if it was compiled from the workbook as it is now, otherwise None.
+def load_snapshot(path, stat, digest):
+    snapshot_path = get_snapshot_path(path)
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        source, config = read_snapshot(snapshot_path)
+    except (OSError, ValueError, KeyError, TypeError) as ex:
+        log.warning("Ignoring snapshot " + snapshot_path + ": " + str(ex))
+        return None
+    if source["sha1"] != digest:
+        log.info("Snapshot " + snapshot_path + " is stale.")
+        return None
+    return config
+
+
+def get_file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(65536), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def parse_workbook(path):
+    import pandas as pd                                     # Only needed when the snapshot is stale
+
+    sheets = pd.read_excel(io=path, sheet_name=None)        # All sheets in one pass
+
+    account_df = sheets[ACCOUNT_SHEET]
+    data_df = sheets[DATA_SHEET]
+    email_df = sheets[EMAIL_SHEET]
+
+    units = {}
+    unit_thresholds = {}
+    for sheet_name, df in sheets.items():
+        if sheet_name.endswith(UNITS_SHEET_SUFFIX):
+            units[sheet_name] = parse_units(df)
+            unit_thresholds[sheet_name] = parse_unit_thresholds(df)
+
+    return PlatformConfig(
+        account_login={"email": to_python(account_df.iloc[0, 1]), "password": to_python(account_df.iloc[1, 1])},
+        dataplicity_login={"email": to_python(account_df.iloc[2, 1]), "password": to_python(account_df.iloc[3, 1])},
+        within_hours=int(data_df.iloc[0, 1]),
+        within_days=int(data_df.iloc[1, 1]),
+        logs_display_page_size=int(data_df.iloc[2, 1]),
+        logs_display_page_number=int(data_df.iloc[3, 1]),
+        smtp_server=to_python(email_df.iloc[0, 1]),
+        port=int(email_df.iloc[1, 1]),
+        sender_email=to_python(email_df.iloc[2, 1]),
+        email_api_key=to_python(email_df.iloc[3, 1]),
+        recipients_iot_team=parse_recipients_field(email_df.iloc[4, 1]),
+        recipients_everyone=parse_recipients_field(email_df.iloc[5, 1]),
+        units=units,
+        unit_thresholds=unit_thresholds,
+        data_fields=parse_fields(data_df),
+        email_fields=parse_fields(email_df),
+    )
+
+
+def parse_units(df):
+    df = df.fillna("")
+    df = df.drop(df.columns[4], axis=1)                     # Notes column
+
+    units = {}
+    for row in df.itertuples(index=False):
+        units[to_python(row[0])] = (to_python(row[1]), to_python(row[2]), to_python(row[3]))
+    return units
+
+
+# Optional WITHIN_HOURS / WITHIN_DAYS columns of a units sheet, found by header, overriding data_sheet per unit.
+def parse_unit_thresholds(df):
+    import pandas as pd
+
+    columns = {}
+    for column in df.columns:
+        name = str(column).split("\n")[0].strip().upper()
+        if name in ("WITHIN_HOURS", "WITHIN_DAYS"):
+            columns[name] = column
+    if not columns:
+        return {}
+
+    thresholds = {}
+    for index, key in enumerate(df.iloc[:, 0]):
+        values = []
+        for name in ("WITHIN_HOURS", "WITHIN_DAYS"):
+            value = df[columns[name]].iloc[index] if name in columns else None
+            values.append(None if value is None or pd.isna(value) else int(value))
+        if values != [None, None]:
+            thresholds[to_python(key)] = tuple(values)
+    return thresholds
+
+
+# Rows of a "NAME | value" sheet, skipping rows with an empty name or value.
+def parse_fields(df):
+    import pandas as pd
+
+    fields = {}
+    for name, value in zip(df.iloc[:, 0], df.iloc[:, 1]):
+        if pd.isna(name) or pd.isna(value):
+            continue
+        fields[str(name).strip()] = to_python(value)
+    return fields
+
+
+def parse_recipients_field(recipients):
+    lst = recipients.split(',')
+    for i in range(len(lst)):
+        lst[i] = lst[i].strip()
+    return lst
+
+
+# numpy scalars -> built-in python types
+def to_python(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return value
@@ -0,0 +1,154 @@
+### Shared HTTP client for Dataplicity, VFlowTechIoT and MADs calls.
+# One requests.Session (and so one keep-alive connection pool) is kept per host for the lifetime of the script,
+# so hourly runs stop paying a new TCP + TLS handshake for every gateway.
+# Retries and the per-host circuit breaker are handled by retry.call(), the adapters do not retry on their own.
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+import retry
+import run_log
+
+log = run_log.get_logger("http")
+
+# Connection pool and timeout of the platform sessions (HTTP_POOL_SIZE, HTTP_TIMEOUT)
+POOL_SIZE                   = 10            # Max keep-alive connections per host
+TIMEOUT                     = 30            # Seconds, applied to every request unless overridden
+
+RequestException = requests.exceptions.RequestException    # Raised for connection errors, timeouts and open circuits
+
+_sessions = {}                              # key: host, value: requests.Session
+_lock = threading.Lock()
+_counts = {}                                # key: "host:port", value: [requests sent, connections opened]
+_counts_lock = threading.Lock()
+_run_baseline = {}                          # key: "host:port", value: (requests, connections) at the start of the run
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def configure(pool_size=POOL_SIZE, timeout=TIMEOUT):
+    global POOL_SIZE, TIMEOUT
+    with _lock:
+        changed = int(pool_size) != POOL_SIZE
+        POOL_SIZE = int(pool_size)
+        TIMEOUT = float(timeout)
+        # Pool size is fixed when the adapter is mounted, rebuild sessions if it changed
+        if changed:
+            for session in _sessions.values():
+                session.close()
+            _sessions.clear()
+
+
+def count(host, port, requests=0, connections=0):
+    with _counts_lock:
+        entry = _counts.setdefault(str(host) + ":" + str(port), [0, 0])
+        entry[0] += requests
+        entry[1] += connections
+
+
+# urllib3's pool counters only see new connection objects. A pooled connection that was closed (by the server, or
+# by a streamed response that was not read to the end) is reopened by the same object, so connect() is counted here.
+class CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        super().connect()
+        count(self.host, self.port, connections=1)
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        super().connect()
+        count(self.host, self.port, connections=1)
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+class CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CountingHTTPConnectionPool, "https": CountingHTTPSConnectionPool}
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        count(parts.hostname, parts.port or DEFAULT_PORTS.get(parts.scheme), requests=1)
+        return super().send(request, **kwargs)
+
+
+def get_session(url):
+    host = urlsplit(url).netloc
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = CountingAdapter(
+                pool_connections=1,                                         # One host per session
+                pool_maxsize=POOL_SIZE,
+                max_retries=0,                                              # See retry.call
+                pool_block=True,                                            # Wait for a free connection instead of opening extras
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    endpoint = metrics.get_endpoint(urlsplit(url).path)
+
+    # Each attempt is timed on its own, backoff sleeps are not latency. Streamed bodies are read after this returns.
+    def send():
+        start = time.monotonic()
+        try:
+            return get_session(url).request(method, url, **kwargs)
+        finally:
+            metrics.REQUEST_SECONDS.observe(time.monotonic() - start, endpoint=endpoint)
+
+    return retry.call(url, send)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+# Returns {"host:port": (requests sent, connections opened)} since the start of the script.
+def connection_counts():
+    with _counts_lock:
+        return {host: tuple(entry) for host, entry in _counts.items()}
+
+
+# Remembers the counters, so report_connection_stats only counts the requests made after this.
+def reset_connection_stats():
+    global _run_baseline
+    _run_baseline = connection_counts()
+
+
+def report_connection_stats():
+    total_opened = 0
+    total_reused = 0
+    for host, (num_requests, num_connections) in connection_counts().items():
+        base_requests, base_connections = _run_baseline.get(host, (0, 0))
+        num_requests -= base_requests
+        opened = num_connections - base_connections
+        reused = max(num_requests - opened, 0)
+        if num_requests == 0:
+            continue
+        log.info(host + ": " + str(num_requests) + " requests, " + str(opened) + " connections opened, " + str(reused) + " reused.")
+        total_opened += opened
+        total_reused += reused
+    log.info("HTTP connections this run: " + str(total_opened) + " opened, " + str(total_reused) + " reused.")
+    return total_opened, total_reused
@@ -0,0 +1,163 @@
+### Incremental JSON decoding for data_dump_index responses.
+# The status check only needs the newest record's timestamp (and the MADs check total_entries), so instead of
+# response.json() (which builds every telemetry record in memory) the body is scanned chunk by chunk and dropped as
+# it is read. Scanning stops as soon as the needed fields are known, so peak memory does not depend on the page size.
+import codecs
+import json
+import re
+
+CHUNK_SIZE                  = 16 * 1024     # Bytes read from the response per chunk
+
+# One token: punctuation, a complete string, or a number / true / false / null
+_TOKEN = re.compile(r'\s*(?:([\[\]{}:,])|("(?:[^"\\]|\\.)*")|([^\s\[\]{}:,"]+))', re.DOTALL)
+# Used while skipping a container: a complete string, a bracket, or the start of a string cut off by the chunk end
+_SKIP = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}]|"', re.DOTALL)
+
+
+# Yields ("scalar", path, value) for every string / number / literal, and ("end", path) when an object or array closes.
+# path is a tuple of object keys and array indexes, e.g. ("data_dumps", 0, "data", "timestamp").
+# chunks is an iterable of bytes (e.g. response.iter_content()) or str.
+# skip(path) is called when an object or array opens; if it returns True the container is jumped over
+# without decoding its contents and only its ("end", path) event is yielded.
+# Like json.loads, an empty body and anything after the top-level value raise json.JSONDecodeError.
+def iter_events(chunks, skip=None):
+    chunks = iter(chunks)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    state = {"buffer": "", "pos": 0, "finished": False}
+
+    # Drop what has been read and append the next chunk, returns False once the body is exhausted.
+    def read_more():
+        if state["finished"]:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            state["finished"] = True
+            chunk = decoder.decode(b"", final=True)
+        elif isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        state["buffer"] = state["buffer"][state["pos"]:] + chunk
+        state["pos"] = 0
+        return True
+
+    # Move past the container that was just opened, up to and including its closing bracket.
+    def skip_container():
+        depth = 1
+        while depth:
+            match = _SKIP.search(state["buffer"], state["pos"])
+            if match is None:
+                state["pos"] = len(state["buffer"])         # Nothing structural left in the buffer
+            elif match.group() == '"':
+                state["pos"] = match.start()                # String continues in the next chunk
+            else:
+                state["pos"] = match.end()
+                if match.group() in "[{":
+                    depth += 1
+                elif match.group() in "]}":
+                    depth -= 1
+                continue
+            if not read_more():
+                raise json.JSONDecodeError("Truncated JSON", state["buffer"], state["pos"])
+
+    frames = []                             # One per open container: [is object, expecting a key]
+    path = []
+    top_level_done = False                  # The top-level value is complete, only whitespace may follow
+    while True:
+        buffer = state["buffer"]
+        match = _TOKEN.match(buffer, state["pos"])
+        # No complete token left in the buffer, or a number / literal that may continue in the next chunk
+        if match is None or (match.group(3) is not None and match.end() == len(buffer) and not state["finished"]):
+            if not read_more():
+                if buffer[state["pos"]:].strip() or frames:
+                    raise json.JSONDecodeError("Truncated or invalid JSON", buffer, state["pos"])
+                if not top_level_done:
+                    raise json.JSONDecodeError("Expecting value", buffer, state["pos"])
+                return
+            continue
+
+        if top_level_done:
+            raise json.JSONDecodeError("Extra data", buffer, match.start())
+        state["pos"] = match.end()
+        punctuation, string, literal = match.groups()
+        if not frames and punctuation in (",", ":"):
+            raise json.JSONDecodeError("Expecting value", buffer, match.start())
+        top_level_done = not frames and punctuation is None  # A top-level scalar
+        if punctuation in ("{", "["):
+            if skip is not None and skip(tuple(path)):
+                skip_container()
+                top_level_done = not frames
+                yield ("end", tuple(path))
+            elif punctuation == "{":
+                frames.append([True, True])
+                path.append(None)
+            else:
+                frames.append([False, False])
+                path.append(0)
+        elif punctuation in ("}", "]"):
+            if not frames:
+                raise json.JSONDecodeError("Unexpected " + punctuation, buffer, state["pos"])
+            frames.pop()
+            path.pop()
+            top_level_done = not frames
+            yield ("end", tuple(path))
+        elif punctuation == ",":
+            if frames and frames[-1][0]:
+                frames[-1][1] = True
+            elif frames:
+                path[-1] += 1
+        elif punctuation == ":":
+            pass
+        elif string is not None and frames and frames[-1][0] and frames[-1][1]:
+            path[-1] = json.loads(string)   # Object key
+            frames[-1][1] = False
+        else:
+            yield ("scalar", tuple(path), json.loads(string if string is not None else literal))
+
+
+# Paths needed from a data_dump_index body, every other object / array is skipped without decoding
+_SUMMARY_PATHS = (("total_entries",), ("data_dumps", 0, "data", "timestamp"))
+
+def _skip_for_summary(path):
+    return not any(wanted[:len(path)] == path for wanted in _SUMMARY_PATHS)
+
+
+# Reads a data_dump_index body and returns it in the shape of response.json(), but with only the fields the
+# status check uses: {"data_dumps": [{"data": {"timestamp": ...}}] or [], "total_entries": ...}
+# Reading stops after the first record. With need_total it goes on until total_entries is found, which may be at the
+# end of the body. Otherwise total_entries is None unless it came first. Without records the rest of the body is
+# small and is read to the end. An empty body, or data after the object when it is read to the end, raise
+# json.JSONDecodeError. A body without a data_dumps array gives no list either (no key, or its scalar value), so the
+# caller fails on it as it would on response.json().
+def read_data_dump_summary(chunks, need_total=False):
+    timestamp = None
+    total_entries = None
+    has_logs = False
+    first_log_done = False
+    found = False                           # data_dumps seen at all
+    scalar = None                           # data_dumps was a scalar (e.g. null) rather than an array
+    for event in iter_events(chunks, skip=_skip_for_summary):
+        path = event[1]
+        if event[0] == "scalar" and path == ("total_entries",):
+            total_entries = event[2]
+        elif path[:1] == ("data_dumps",):
+            found = True
+            if len(path) == 1:                  # data_dumps closed
+                first_log_done = True
+                if event[0] == "scalar":
+                    scalar = (event[2],)
+            else:
+                has_logs = True
+                if path[1] != 0 or (event[0] == "end" and len(path) == 2):
+                    first_log_done = True       # Past the first record
+                elif event[0] == "scalar" and path[2:] == ("data", "timestamp"):
+                    timestamp = event[2]
+        if first_log_done and has_logs and (total_entries is not None or not need_total):
+            break
+
+    if not found:
+        return {"total_entries": total_entries}
+    if scalar is not None:
+        return {"data_dumps": scalar[0], "total_entries": total_entries}
+    data_dumps = []
+    if has_logs:
+        data_dumps.append({"data": {} if timestamp is None else {"timestamp": timestamp}})
+    return {"data_dumps": data_dumps, "total_entries": total_entries}
@@ -0,0 +1,255 @@
+### Delivery of the status emails through a durable outbox.
+# sendEmail does not talk to the SMTP server. Each email is written to OUTBOX_DIR as one JSON file and a background
+# thread delivers the outbox, so a run never waits for or fails on SMTP. The worker sends every due email over one SSL
+# connection and login, and reconnects only when the connection drops. Emails that could not be sent stay in the
+# outbox and are tried again with exponential backoff (RETRY_BASE_SECONDS doubling up to RETRY_MAX_SECONDS), also
+# after a restart of the service. Emails the server refuses for good, or still not sent after EXPIRE_HOURS, are
+# moved to OUTBOX_DIR/failed/.
+# test/smtp_stub.py is a local SMTP server to try this without a mail account (SMTP_SSL FALSE), see
+# test/outbox_check.py.
+import json
+import os
+import smtplib
+import socket
+import ssl
+import threading
+import time
+import uuid
+
+import metrics
+import run_log
+
+log = run_log.get_logger("mailer")
+
+# SMTP account and retry policy of the outbox, from email_sheet
+SMTP_SERVER                 = None
+PORT                        = None
+SENDER                      = None
+PASSWORD                    = None
+USE_SSL                     = True          # SMTP over SSL, FALSE for a plain SMTP server such as test/smtp_stub.py
+TIMEOUT                     = 30            # Seconds an SMTP connect or command may take before the session is dropped
+RETRY_BASE_SECONDS          = 30            # Wait before the second attempt of an email, doubling with each attempt
+RETRY_MAX_SECONDS           = 900           # Longest wait between two attempts
+EXPIRE_HOURS                = 24            # Emails not sent by then are moved to failed/
+
+OUTBOX_DIR                  = "data_dump/outbox"
+RECONNECTS                  = 1             # New sessions opened per email after the connection dropped
+POLL_SECONDS                = 60            # Longest sleep of the worker between two looks at the outbox
+
+# Connection failures worth a new session, refused recipients or bad credentials are not. A server that stops
+# answering raises socket.timeout after TIMEOUT, the email is then tried again like after any other outage.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, socket.timeout)
+# Answers about the email itself rather than the session
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+
+SESSION_SECONDS = 0.0                       # Time the last delivery spent in SMTP, connecting included
+SESSIONS_OPENED = 0                         # Sessions the last delivery opened
+
+_session = None                             # SMTP connection of the worker while delivering
+_worker = None
+_wake = threading.Event()
+_lock = threading.Lock()
+
+
+def configure(smtp_server, port, sender, password, use_ssl=USE_SSL, retry_base_seconds=RETRY_BASE_SECONDS,
+              retry_max_seconds=RETRY_MAX_SECONDS, expire_hours=EXPIRE_HOURS, timeout=TIMEOUT):
+    global SMTP_SERVER, PORT, SENDER, PASSWORD, USE_SSL, RETRY_BASE_SECONDS, RETRY_MAX_SECONDS, EXPIRE_HOURS, TIMEOUT
+    SMTP_SERVER = smtp_server
+    PORT = int(port)
+    SENDER = sender
+    PASSWORD = password
+    USE_SSL = bool(use_ssl)
+    RETRY_BASE_SECONDS = float(retry_base_seconds)
+    RETRY_MAX_SECONDS = float(retry_max_seconds)
+    EXPIRE_HOURS = float(expire_hours)
+    TIMEOUT = float(timeout)
+
+
+# Writes the email to the outbox, it is sent by the worker after the next flush().
+# run names the run that queued the email (e.g. "VFT 14:00") in the delivery log.
+def queue(message, recipients, run=None):
+    os.makedirs(OUTBOX_DIR, exist_ok=True)
+    now = time.time()
+    entry = {"recipients": [recipient.strip() for recipient in recipients], "message": message, "run": run,
+             "queued_at": now, "attempts": 0, "next_attempt": now, "last_error": None}
+    name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + ".%06d" % (now % 1 * 1000000) + "-" + uuid.uuid4().hex[:8] + ".json"
+    _write(os.path.join(OUTBOX_DIR, name), entry)
+
+
+def get_queue_size():
+    return len(_list_outbox())
+
+
+# Wakes the worker to deliver the outbox, starting it if needed. Does not wait for the delivery.
+def flush():
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="mailer", daemon=True)
+            _worker.start()
+    _wake.set()
+
+
+def _run():
+    while True:
+        try:
+            wait = deliver()
+        except Exception:
+            log.exception("Email delivery failed.")
+            wait = POLL_SECONDS
+        _wake.wait(timeout=wait)
+        _wake.clear()
+
+
+# Sends every email of the outbox that is due, returns the seconds until the next one is due (at most POLL_SECONDS).
+def deliver():
+    global SESSION_SECONDS, SESSIONS_OPENED
+    if SMTP_SERVER is None:                 # Not configured yet
+        return POLL_SECONDS
+    now = time.time()
+    due = []
+    wait = POLL_SECONDS
+    for path in _list_outbox():
+        entry = _read(path)
+        if entry is None:                   # Unreadable, keep it out of the way
+            os.makedirs(os.path.join(OUTBOX_DIR, "failed"), exist_ok=True)
+            os.replace(path, os.path.join(OUTBOX_DIR, "failed", os.path.basename(path)))
+            continue
+        if entry["next_attempt"] <= now:
+            due.append((path, entry))
+        else:
+            wait = min(wait, entry["next_attempt"] - now)
+    if not due:
+        return wait
+
+    start = time.monotonic()
+    SESSIONS_OPENED = 0
+    sent = 0
+    runs = {}                               # key: run that queued the emails, value: [sent, SMTP seconds, oldest queued_at]
+    try:
+        for index, (path, entry) in enumerate(due):
+            send_start = time.monotonic()
+            try:
+                _send(entry)
+            except MESSAGE_ERRORS as ex:
+                if getattr(ex, "smtp_code", 500) >= 500:
+                    _fail(path, entry, ex)
+                else:
+                    _reschedule(path, entry, ex)
+                continue
+            except Exception as ex:         # Server unreachable or login refused, try the rest of the outbox later
+                for path, entry in due[index:]:
+                    _reschedule(path, entry, ex)
+                break
+            finally:
+                metrics.EMAIL_SECONDS.observe(time.monotonic() - send_start)
+            os.remove(path)
+            sent += 1
+            metrics.EMAILS.inc(result="sent")
+            run = runs.setdefault(entry.get("run"), [0, 0.0, entry["queued_at"]])
+            run[0] += 1
+            run[1] += time.monotonic() - send_start
+            run[2] = min(run[2], entry["queued_at"])
+    finally:
+        _close_session()
+        SESSION_SECONDS = time.monotonic() - start
+        metrics.SMTP_SECONDS.observe(SESSION_SECONDS)
+        metrics.OUTBOX_SIZE.set(get_queue_size())
+    log.info("Sent " + str(sent) + " of " + str(len(due)) + " email(s) from the outbox in "
+             + str(round(SESSION_SECONDS, 2)) + " seconds over " + str(SESSIONS_OPENED) + " SMTP session(s).")
+    for run, (run_sent, seconds, queued_at) in runs.items():
+        if run is not None:                 # Queued before emails were tagged with their run
+            log.info("Emails of the " + run + " run: " + str(run_sent) + " sent in " + str(round(seconds, 2))
+                     + " seconds of SMTP, " + str(round(time.time() - queued_at, 1)) + " seconds after being queued.")
+    return min(POLL_SECONDS, RETRY_BASE_SECONDS) if sent < len(due) else POLL_SECONDS
+
+
+def _send(entry):
+    global _session, SESSIONS_OPENED
+    for attempt in range(RECONNECTS + 1):
+        try:
+            if _session is None:
+                _session = _connect()
+                SESSIONS_OPENED += 1
+            _session.sendmail(SENDER, entry["recipients"], entry["message"])
+            return
+        except CONNECTION_ERRORS as ex:
+            _close_session()
+            if attempt == RECONNECTS:
+                raise
+            log.warning("SMTP connection lost (" + str(ex) + "), reconnecting.")
+
+
+def _connect():
+    if USE_SSL:
+        server = smtplib.SMTP_SSL(SMTP_SERVER, PORT, timeout=TIMEOUT, context=ssl.create_default_context())
+    else:
+        server = smtplib.SMTP(SMTP_SERVER, PORT, timeout=TIMEOUT)
+    try:
+        server.login(SENDER, PASSWORD)
+    except Exception:
+        _close(server)
+        raise
+    return server
+
+
+def _close_session():
+    global _session
+    _close(_session)
+    _session = None
+
+
+def _close(server):
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def _reschedule(path, entry, error):
+    entry["attempts"] += 1
+    entry["last_error"] = str(error)
+    if time.time() - entry["queued_at"] > EXPIRE_HOURS * 60 * 60:
+        _fail(path, entry, error)
+        return
+    metrics.EMAILS.inc(result="retry")
+    entry["next_attempt"] = time.time() + min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (entry["attempts"] - 1))
+    _write(path, entry)
+    log.warning("Email " + os.path.basename(path) + " not sent (" + str(error) + "), attempt " + str(entry["attempts"])
+                + ", next in " + str(round(entry["next_attempt"] - time.time())) + " seconds.")
+
+
+def _fail(path, entry, error):
+    entry["last_error"] = str(error)
+    failed_dir = os.path.join(OUTBOX_DIR, "failed")
+    os.makedirs(failed_dir, exist_ok=True)
+    _write(os.path.join(failed_dir, os.path.basename(path)), entry)
+    os.remove(path)
+    metrics.EMAILS.inc(result="failed")
+    log.error("Email " + os.path.basename(path) + " moved to " + failed_dir + ": " + str(error))
+
+
+# Outbox files, oldest first
+def _list_outbox():
+    if not os.path.isdir(OUTBOX_DIR):
+        return []
+    return [os.path.join(OUTBOX_DIR, name) for name in sorted(os.listdir(OUTBOX_DIR)) if name.endswith(".json")]
+
+
+def _read(path):
+    try:
+        with open(path, encoding="utf-8") as infile:
+            return json.load(infile)
+    except (OSError, ValueError) as ex:
+        log.warning("Could not read " + path + ": " + str(ex))
+        return None
+
+
+# Written to a temporary file first, so a crash never leaves half an email in the outbox
+def _write(path, entry):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as outfile:
+        json.dump(entry, outfile)
+    os.replace(temp_path, path)
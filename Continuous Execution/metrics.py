@@ -0,0 +1,228 @@
+### Run metrics in the Prometheus text format.
+# The script records the latency of every platform request (by endpoint: sign_in, devices, data_dump_index), the
+# duration of every phase of generate_report, the units per status of the latest run, retries and the time spent
+# sending emails. start() serves them on http://ADDRESS:PORT/metrics for a Prometheus scrape and rewrites FILE_PATH
+# every FILE_SECONDS (and after every run), for node_exporter's textfile collector or a plain `cat`.
+# Counters and histograms count from the start of the service, gauges hold the latest run.
+import http.server
+import os
+import threading
+
+import run_log
+
+log = run_log.get_logger("metrics")
+
+# Where the metrics are served and how often the metrics file is rewritten (METRICS_* rows)
+ADDRESS                     = "127.0.0.1"   # Only reachable from the board unless set to 0.0.0.0
+PORT                        = 9108          # 0 disables the HTTP endpoint
+FILE_SECONDS                = 60            # Interval of the metrics file, 0 disables the file
+FILE_PATH                   = "data_dump/metrics.prom"
+
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800)
+EMAIL_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []                               # Every metric, in the order they are rendered
+_lock = threading.Lock()
+_server = None
+_writer = None
+_wake = threading.Event()
+
+
+class Metric:
+    def __init__(self, name, help, kind, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = tuple(labels)
+        self.values = {}                    # key: tuple of label values
+        _metrics.append(self)
+        if not self.labels:                 # Rendered from the start, as 0
+            self.values[()] = self.get_zero()
+
+    def get_zero(self):
+        return 0
+
+    def get_key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " " + self.kind]
+        for key, value in sorted(self.values.items()):
+            lines.append(self.name + format_labels(zip(self.labels, key)) + " " + format_value(value))
+        return lines
+
+
+class Counter(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, "counter", labels)
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, "gauge", labels)
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets, labels=()):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, "histogram", labels)
+
+    # values: {key: [count per bucket, sum, count]}, the bucket counts are not cumulative
+    def get_zero(self):
+        return [[0] * len(self.buckets), 0.0, 0]
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with _lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = self.get_zero()
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " histogram"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(self.name + "_bucket" + format_labels(labels + [("le", format_value(bound))]) + " " + str(cumulative))
+            lines.append(self.name + "_bucket" + format_labels(labels + [("le", "+Inf")]) + " " + str(count))
+            lines.append(self.name + "_sum" + format_labels(labels) + " " + format_value(total))
+            lines.append(self.name + "_count" + format_labels(labels) + " " + str(count))
+        return lines
+
+
+REQUEST_SECONDS = Histogram("unit_status_request_seconds", "Latency of platform requests, every retry counted on its own.",
+                            REQUEST_BUCKETS, labels=("endpoint",))
+PHASE_SECONDS = Histogram("unit_status_phase_seconds", "Wall time of the phases of a run.", PHASE_BUCKETS, labels=("phase",))
+RUN_SECONDS = Gauge("unit_status_run_seconds", "Wall time of the latest run.", labels=("system",))
+RUNS = Counter("unit_status_runs_total", "Runs of generate_report.", labels=("system",))
+LAST_RUN = Gauge("unit_status_last_run_timestamp_seconds", "End of the latest run, in epoch seconds.", labels=("system",))
+UNITS = Gauge("unit_status_units", "Units per platform status in the latest run.", labels=("system", "status"))
+RETRIES = Counter("unit_status_http_retries_total", "Platform requests retried.")
+FAILED_FAST = Counter("unit_status_http_failed_fast_total", "Platform requests failed without a try because the host's circuit was open.")
+CIRCUITS_OPENED = Counter("unit_status_http_circuits_opened_total", "Times a host's circuit breaker opened.")
+EMAIL_SECONDS = Histogram("unit_status_email_send_seconds", "Time spent on one email of the outbox, connecting and failed attempts included.", EMAIL_BUCKETS)
+SMTP_SECONDS = Histogram("unit_status_smtp_delivery_seconds", "Time one delivery of the outbox spent in SMTP, connecting included.", EMAIL_BUCKETS)
+EMAILS = Counter("unit_status_emails_total", "Outbox delivery attempts by result: sent, retry or failed.", labels=("result",))
+OUTBOX_SIZE = Gauge("unit_status_outbox_emails", "Emails waiting in the outbox after the latest delivery.")
+
+
+def configure(address=ADDRESS, port=PORT, file_seconds=FILE_SECONDS):
+    global ADDRESS, PORT, FILE_SECONDS
+    ADDRESS = str(address)
+    PORT = int(port)
+    FILE_SECONDS = float(file_seconds)
+
+
+# Starts the HTTP endpoint and the metrics file writer. Does nothing for parts already running or disabled,
+# a changed port takes effect after a restart of the service.
+def start():
+    global _server, _writer
+    if PORT > 0 and _server is None:
+        try:
+            _server = http.server.ThreadingHTTPServer((ADDRESS, PORT), MetricsHandler)
+        except OSError as ex:
+            log.warning("Metrics endpoint not started on " + ADDRESS + ":" + str(PORT) + ": " + str(ex))
+        else:
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+            log.info("Metrics served on http://" + ADDRESS + ":" + str(_server.server_address[1]) + "/metrics")
+    if FILE_SECONDS > 0 and _writer is None:
+        _writer = threading.Thread(target=_run_writer, name="metrics-file", daemon=True)
+        _writer.start()
+
+
+# Wakes the writer to rewrite the metrics file now, called at the end of a run
+def flush():
+    _wake.set()
+
+
+def render():
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# Written to a temporary file first, so a reader never sees half a file
+def write_file(path=None):
+    path = path or FILE_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as outfile:
+        outfile.write(render())
+    os.replace(temp_path, path)
+
+
+def _run_writer():
+    while True:
+        try:
+            write_file()
+        except OSError as ex:
+            log.warning("Could not write " + FILE_PATH + ": " + str(ex))
+        _wake.wait(timeout=FILE_SECONDS)
+        _wake.clear()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Endpoint label of a platform request, by URL path
+def get_endpoint(path):
+    path = path.rstrip("/")
+    if path.endswith("/auth") or path.endswith("/sign-in"):
+        return "sign_in"
+    if path.endswith("/devices"):
+        return "devices"
+    if path.endswith("/data_dump_index"):
+        return "data_dump_index"
+    return "other"
+
+
+def format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + escape(value) + '"' for name, value in labels) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,120 @@
+### Rendering of unit_status.docx.
+# python-docx adds table rows through proxy objects (table.add_row(), cell.text, an xpath lookup per shaded cell),
+# which gets slow as the table grows. Here the XML of all unit rows is generated as one string, with the shading of
+# each status precomputed, and parsed in a single call. The document is the same as the one built cell by cell.
+# test/benchmark_report.py compares both paths.
+# render_report_cached() skips the rendering when the status table is the same as the one the file was written from,
+# compared by a hash of the table, and read_report() keeps the attachment bytes until the file changes.
+import hashlib
+import json
+import os
+import re
+from xml.sax.saxutils import escape
+
+from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+
+# Cell shading per status
+PLATFORM_FILLS = {"online": "CEEDD0", "offline": "F6CACF", "partial": "FBEBA6", "error": "FF0000"}
+DATAPLICITY_FILLS = {"online": "CEEDD0", "offline": "F6CACF"}
+PARTIAL_FILL = "FBEBA6"                     # Dataplicity cell of a partial unit when Dataplicity is neither online nor offline
+
+_SHADING = {fill: '<w:shd w:fill="' + fill + '"/>' for fill in set(PLATFORM_FILLS.values()) | set(DATAPLICITY_FILLS.values())}
+_RUN_BREAKS = re.compile(r"([\t\r\n])")
+
+_rendered = {}                              # key: path, value: (hash of the table, mtime of the file written from it)
+_contents = {}                              # key: path, value: (mtime, bytes of the file)
+
+
+# rows: list of (unit name, platform status, Dataplicity status, location, remarks)
+def render_report(path, system, rows):
+    document = Document()
+    document.add_heading("Unit Status", 0)
+    table = document.add_table(rows=1, cols=5)
+    heading_cells = table.rows[0].cells
+    heading_cells[0].text = "Unit Name"
+    heading_cells[1].text = system
+    heading_cells[2].text = "Dataplicity"
+    heading_cells[3].text = "Location"
+    heading_cells[4].text = "Remarks"
+    append_rows(table, rows)
+    table.style = "Table Grid"
+    document.save(path)
+
+
+# Same as render_report, unless the file at path is still the one written from the same system and rows.
+# Returns True if the report was rendered, False if the existing file was kept.
+def render_report_cached(path, system, rows):
+    digest = get_digest(system, rows)
+    previous = _rendered.get(path)
+    if previous is not None and previous[0] == digest and _get_mtime(path) == previous[1]:
+        return False
+    render_report(path, system, rows)
+    _rendered[path] = (digest, _get_mtime(path))
+    return True
+
+
+# Content hash of the status table
+def get_digest(system, rows):
+    table = json.dumps([system, [[str(text) for text in row] for row in rows]], ensure_ascii=False)
+    return hashlib.sha256(table.encode("utf-8")).hexdigest()
+
+
+# Bytes of the report for the email attachment, read again only when the file changed.
+def read_report(path):
+    mtime = _get_mtime(path)
+    cached = _contents.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as report:
+            cached = (mtime, report.read())
+        _contents[path] = cached
+    return cached[1]
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def append_rows(table, rows):
+    tbl = table._tbl
+    cell_starts = ['<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="' + str(gridCol.w.twips) + '"/>' for gridCol in tbl.tblGrid.gridCol_lst]
+    parts = []
+    for unit, platform, dataplicity, location, remarks in rows:
+        fills = ("", _get_shading(PLATFORM_FILLS.get(platform)), _get_shading(get_dataplicity_fill(platform, dataplicity)), "", "")
+        parts.append("<w:tr>")
+        for cell_start, fill, text in zip(cell_starts, fills, (unit, platform, dataplicity, location, remarks)):
+            parts.append(cell_start + fill + "</w:tcPr><w:p><w:r>" + _get_run_xml(str(text)) + "</w:r></w:p></w:tc>")
+        parts.append("</w:tr>")
+    if parts:
+        fragment = parse_xml("<w:tbl " + nsdecls("w") + ">" + "".join(parts) + "</w:tbl>")
+        tbl.extend(list(fragment))
+
+
+def get_dataplicity_fill(platform, dataplicity):
+    if dataplicity in DATAPLICITY_FILLS:
+        return DATAPLICITY_FILLS[dataplicity]
+    if platform == "partial":
+        return PARTIAL_FILL
+    return None
+
+
+def _get_shading(fill):
+    return "" if fill is None else _SHADING[fill]
+
+
+# Run content like python-docx's run.text: tabs and line breaks become <w:tab/> and <w:br/>
+def _get_run_xml(text):
+    xml = []
+    for part in _RUN_BREAKS.split(text):
+        if part == "\t":
+            xml.append("<w:tab/>")
+        elif part in ("\r", "\n"):
+            xml.append("<w:br/>")
+        elif part:
+            space = ' xml:space="preserve"' if part.strip() != part else ""
+            xml.append("<w:t" + space + ">" + escape(part) + "</w:t>")
+    return "".join(xml)
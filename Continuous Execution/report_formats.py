@@ -0,0 +1,127 @@
+### Report outputs next to unit_status.docx.
+# The same status table can be written as JSON, CSV and a small self-contained HTML page. The three text formats are
+# built in one pass over the rows. Each recipient list has its own formats (optional rows in email_sheet), a run only
+# renders the formats its emails need. The HTML page is sent inline in the email instead of as an attachment.
+# Like the docx, an output is only written again when the table changed since the file was written.
+import csv
+import html
+import io
+import json
+import os
+
+import report_docx
+import run_log
+
+log = run_log.get_logger("report")
+
+FORMATS                     = ("docx", "json", "csv", "html")
+DEFAULT_FORMATS             = ("docx",)
+COLUMNS                     = ("unit", "platform", "dataplicity", "location", "remarks")
+
+# MIME subtype of each attached format
+SUBTYPES = {"docx": "docx", "json": "json", "csv": "csv"}
+
+_rendered = {}                              # key: path, value: (hash of the table, mtime of the file written from it)
+
+read_report = report_docx.read_report
+
+
+# "docx, html" -> ("docx", "html"), unknown names are skipped, DEFAULT_FORMATS when nothing is left
+def parse_formats(value):
+    formats = []
+    for name in str(value).split(","):
+        name = name.strip().lower()
+        if not name:
+            continue
+        if name not in FORMATS:
+            log.warning("Unknown report format " + name + ", expected one of " + ", ".join(FORMATS) + ".")
+        elif name not in formats:
+            formats.append(name)
+    return tuple(formats) or DEFAULT_FORMATS
+
+
+# docx file name -> file name of the format, e.g. unit_status.docx -> unit_status.csv
+def get_path(docx_path, format):
+    return os.path.splitext(docx_path)[0] + "." + format
+
+
+# Writes the given formats of the table next to docx_path, returns {format: path}.
+# rows: list of (unit name, platform status, Dataplicity status, location, remarks)
+def render(docx_path, system, rows, formats):
+    paths = {format: get_path(docx_path, format) for format in formats}
+    reused = []
+    if "docx" in paths:
+        paths["docx"] = docx_path
+        if not report_docx.render_report_cached(docx_path, system, rows):
+            reused.append(docx_path)
+    digest = report_docx.get_digest(system, rows)
+    stale = []
+    for format in formats:
+        if format == "docx":
+            continue
+        if _is_current(paths[format], digest):
+            reused.append(paths[format])
+        else:
+            stale.append(format)
+    if stale:
+        for format, content in render_text(system, rows, stale).items():
+            with open(paths[format], "w", encoding="utf-8", newline="") as outfile:
+                outfile.write(content)
+            _rendered[paths[format]] = (digest, _get_mtime(paths[format]))
+    if reused:
+        log.info("Unit statuses unchanged, reusing " + ", ".join(reused) + ".")
+    return paths
+
+
+# JSON, CSV and HTML of the table in one pass over the rows, returns {format: text} for the requested formats
+def render_text(system, rows, formats):
+    units = []
+    csv_out = io.StringIO()
+    csv_writer = csv.writer(csv_out)
+    csv_writer.writerow(COLUMNS)
+    html_rows = []
+    for row in rows:
+        row = [str(text) for text in row]
+        unit, platform, dataplicity, location, remarks = row
+        units.append(dict(zip(COLUMNS, row)))
+        csv_writer.writerow(row)
+        fills = (None, report_docx.PLATFORM_FILLS.get(platform), report_docx.get_dataplicity_fill(platform, dataplicity), None, None)
+        html_rows.append("<tr>" + "".join(_get_html_cell(text, fill) for text, fill in zip(row, fills)) + "</tr>")
+
+    outputs = {}
+    if "json" in formats:
+        outputs["json"] = json.dumps({"system": system, "units": units}, ensure_ascii=False, indent=1)
+    if "csv" in formats:
+        outputs["csv"] = csv_out.getvalue()
+    if "html" in formats:
+        heading = "".join("<th>" + html.escape(text) + "</th>" for text in ("Unit Name", system, "Dataplicity", "Location", "Remarks"))
+        outputs["html"] = (
+            '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Unit Status</title></head><body>'
+            "<h1>Unit Status</h1>"
+            '<table border="1" cellpadding="4" style="border-collapse:collapse;font-family:sans-serif;font-size:13px">'
+            "<tr>" + heading + "</tr>" + "".join(html_rows) + "</table></body></html>"
+        )
+    return outputs
+
+
+# HTML email from the plain body text and the HTML report
+def build_html_email(body, report_html):
+    text = '<pre style="font-family:sans-serif">' + html.escape(body) + "</pre>"
+    return report_html.replace("<body>", "<body>" + text, 1)
+
+
+def _get_html_cell(text, fill):
+    style = "" if fill is None else ' style="background:#' + fill + '"'
+    return "<td" + style + ">" + html.escape(text).replace("\n", "<br>") + "</td>"
+
+
+def _is_current(path, digest):
+    previous = _rendered.get(path)
+    return previous is not None and previous[0] == digest and _get_mtime(path) == previous[1]
+
+
+def _get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
@@ -0,0 +1,190 @@
+### Retry policy and per-host circuit breaker for platform calls.
+# Every request made through http_client goes through call(). Connection errors, timeouts and HTTP 429 / 5xx
+# responses are retried with capped exponential backoff and full jitter: before retry n the caller sleeps a random
+# time in [0, min(MAX_DELAY, BASE_DELAY * 2^n)], so gateways that failed together do not retry in lockstep.
+# The sleep happens in the calling thread, so in the VFT sweep each worker backs off on its own while the others continue.
+#
+# The circuit breaker counts consecutive host-level failures (connection errors, timeouts, HTTP 502 / 503 / 504).
+# After BREAKER_FAILURES in a row the host is treated as down and calls fail immediately with CircuitOpenError
+# for BREAKER_OPEN_SECONDS. Then a single trial call is let through: if the host answers the circuit closes,
+# otherwise it opens again. HTTP 500 is retried but not counted, VFlowTechIoT returns it for single gateways
+# that have not been queried for a while.
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics
+import run_log
+
+log = run_log.get_logger("retry")
+
+# Backoff and circuit breaker limits (HTTP_RETRIES, RETRY_*, BREAKER_* rows)
+MAX_RETRIES                 = 4             # Retries per request, on top of the first attempt
+BASE_DELAY                  = 2             # Seconds, backoff cap before the first retry
+MAX_DELAY                   = 30            # Seconds, backoff never exceeds this
+BREAKER_FAILURES            = 10            # Consecutive host-level failures that open the circuit
+BREAKER_OPEN_SECONDS        = 60            # How long an open circuit fails fast before a trial call
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+BREAKER_STATUS = (502, 503, 504)
+
+_breakers = {}                              # key: host, value: CircuitBreaker
+_lock = threading.Lock()
+_stats = {"retries": 0, "failed_fast": 0, "circuits_opened": 0}
+_counters = {"retries": metrics.RETRIES, "failed_fast": metrics.FAILED_FAST, "circuits_opened": metrics.CIRCUITS_OPENED}
+_local = threading.local()                  # Retries made by the current thread, see get_retry_count
+
+
+# A ConnectionError, so callers handling requests exceptions also handle an open circuit
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None               # time.monotonic() when the circuit opened, None while closed
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    # Raises CircuitOpenError while the host is down, otherwise lets the call through
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial_running or time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                _count("failed_fast")
+                raise CircuitOpenError(self.host + " is unavailable, circuit open.")
+            self.trial_running = True       # Half open, this call is the trial
+
+    # The host answered, whatever the status code
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info("Circuit for " + self.host + " closed.")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or (self.opened_at is None and self.failures >= BREAKER_FAILURES):
+                log.warning(
+                    "Circuit for " + self.host + " opened after " + str(self.failures)
+                    + " consecutive failures, failing fast for " + str(BREAKER_OPEN_SECONDS) + " seconds."
+                )
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+                _count("circuits_opened")
+
+    # The trial call ended without telling whether the host is up (e.g. an invalid request)
+    def release_trial(self):
+        with self.lock:
+            self.trial_running = False
+
+
+def configure(max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+              breaker_failures=BREAKER_FAILURES, breaker_open_seconds=BREAKER_OPEN_SECONDS):
+    global MAX_RETRIES, BASE_DELAY, MAX_DELAY, BREAKER_FAILURES, BREAKER_OPEN_SECONDS
+    MAX_RETRIES = int(max_retries)
+    BASE_DELAY = float(base_delay)
+    MAX_DELAY = float(max_delay)
+    BREAKER_FAILURES = int(breaker_failures)
+    BREAKER_OPEN_SECONDS = float(breaker_open_seconds)
+
+
+def get_breaker(host):
+    with _lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+# Calls send() (which makes one request to url and returns the response) with retries, returns the last response.
+# Raises CircuitOpenError if the host is down, or the last connection error / timeout once retries are used up.
+def call(url, send):
+    breaker = get_breaker(urlsplit(url).netloc)
+    attempt = 0
+    while True:
+        breaker.before_call()
+        retry_after = None
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+            breaker.record_failure()
+            if attempt >= MAX_RETRIES:
+                raise
+            reason = type(ex).__name__
+        except Exception:
+            breaker.release_trial()
+            raise
+        else:
+            if response.status_code in BREAKER_STATUS:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status_code not in RETRY_STATUS or attempt >= MAX_RETRIES:
+                return response
+            reason = "HTTP " + str(response.status_code)
+            retry_after = get_retry_after(response)
+            response.close()
+
+        delay = get_delay(attempt, retry_after)
+        attempt += 1
+        _count("retries")
+        _local.retries = get_retry_count() + 1
+        log.debug(                          # Per request, summed up by report_stats
+            reason + " from " + url + ", retry " + str(attempt) + " of " + str(MAX_RETRIES)
+            + " in " + str(round(delay, 1)) + " seconds."
+        )
+        time.sleep(delay)
+
+
+# Full jitter, stretched to the server's Retry-After (within MAX_DELAY) when it sent one
+def get_delay(attempt, retry_after=None):
+    delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = min(max(delay, retry_after), MAX_DELAY)
+    return delay
+
+
+# Retry-After in seconds, None if missing or given as a date
+def get_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Total retries made by the calling thread, compare two readings to count the retries of a block of requests
+def get_retry_count():
+    return getattr(_local, "retries", 0)
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+    _counters[name].inc()
+
+
+# Zeroes the counts behind report_stats, the totals in metrics are kept.
+def reset_stats():
+    with _lock:
+        for name in _stats:
+            _stats[name] = 0
+
+
+def report_stats():
+    with _lock:
+        stats = dict(_stats)
+    log.info(
+        "Retries this run: " + str(stats["retries"]) + ", failed fast: " + str(stats["failed_fast"])
+        + ", circuits opened: " + str(stats["circuits_opened"]) + "."
+    )
+    return stats
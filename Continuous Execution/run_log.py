@@ -0,0 +1,196 @@
+### Leveled logging of the script, replacing print.
+# Every module logs through get_logger(). Records go to three places:
+#   console     LEVEL and above, as text, what the tmux session shows
+#   FILE        LEVEL and above, as one JSON object per line, rotated at MAX_BYTES with BACKUPS old files kept
+#   ring buffer the last RING_SIZE records of every level, debug included, kept in memory only
+# Per-unit lines (online on Dataplicity, partial data, cache hits, ...) are logged at debug level with the unit in
+# their fields, so the console and the file grow with the number of runs rather than the size of the fleet.
+# An error record writes the ring buffer to DUMP_DIR (at most once every DUMP_MIN_SECONDS), so the debug lines that
+# led up to the error are kept without logging them all the time.
+# Context fields are passed with extra=fields(unit=..., gateway=...) and appear as key=value on the console and as
+# keys of the JSON object in the file.
+import collections
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+
+# Log level, log file rotation and ring buffer size (LOG_* rows)
+LEVEL                       = logging.INFO  # Console and file
+FILE                        = "logs/unit_status.log"    # Empty or NONE to log to the console only
+MAX_BYTES                   = 5 * 1024 * 1024           # Size at which the file is rotated
+BACKUPS                     = 5             # Rotated files kept, unit_status.log.1 to .5
+RING_SIZE                   = 2000          # Records kept in memory for a dump, 0 disables the ring buffer
+
+DUMP_DIR                    = "logs"
+DUMP_MIN_SECONDS            = 300           # Errors in quick succession only dump the ring buffer once
+DUMP_KEEP                   = 20            # Dumps kept in DUMP_DIR, the oldest are deleted
+
+_logger = logging.getLogger("unit_status")
+_lock = threading.Lock()
+_console = None
+_file = None
+_ring = None
+_last_dump = None
+
+
+def get_logger(name=None):
+    return _logger if name is None else _logger.getChild(name)
+
+
+# Context fields of a record, e.g. log.debug("Online on Dataplicity.", extra=fields(unit=unit_name))
+def fields(**values):
+    return {"fields": values}
+
+
+def configure(level=LEVEL, file=FILE, max_bytes=MAX_BYTES, backups=BACKUPS, ring_size=RING_SIZE):
+    global LEVEL, FILE, MAX_BYTES, BACKUPS, RING_SIZE, _file
+    level = parse_level(level)
+    file = str(file or "").strip()
+    if file.upper() == "NONE":
+        file = ""
+    max_bytes = int(max_bytes)
+    backups = int(backups)
+    ring_size = int(ring_size)
+    with _lock:
+        file_changed = (file, max_bytes, backups) != (FILE, MAX_BYTES, BACKUPS) or (_file is None and file)
+        LEVEL, FILE, MAX_BYTES, BACKUPS, RING_SIZE = level, file, max_bytes, backups, ring_size
+        if file_changed:                    # Called before every run, the file is only reopened when its settings changed
+            _remove_handler(_file)
+            _file = None
+            if FILE:
+                os.makedirs(os.path.dirname(FILE) or ".", exist_ok=True)
+                _file = logging.handlers.RotatingFileHandler(FILE, maxBytes=MAX_BYTES, backupCount=BACKUPS, encoding="utf-8")
+                _file.setFormatter(JsonFormatter())
+                _add_handler(_file)
+        _apply_levels()
+
+
+# Writes the ring buffer to DUMP_DIR as JSON lines, returns the path or None if there was nothing to write
+def dump(reason=""):
+    global _last_dump
+    if _ring is None or not _ring.records:
+        return None
+    records = list(_ring.records)
+    os.makedirs(DUMP_DIR, exist_ok=True)
+    path = os.path.join(DUMP_DIR, "dump-" + time.strftime("%Y%m%d-%H%M%S") + ".jsonl")
+    formatter = JsonFormatter()
+    with open(path, "w", encoding="utf-8") as outfile:
+        for record in records:
+            outfile.write(formatter.format(record) + "\n")
+    _last_dump = time.monotonic()
+    dumps = sorted(name for name in os.listdir(DUMP_DIR) if name.startswith("dump-") and name.endswith(".jsonl"))
+    for name in dumps[:-DUMP_KEEP]:
+        os.remove(os.path.join(DUMP_DIR, name))
+    _logger.info("Wrote the last " + str(len(records)) + " log records to " + path + (" (" + reason + ")" if reason else "") + ".")
+    return path
+
+
+def parse_level(level):
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(str(level).strip().upper())
+    if not isinstance(value, int):
+        raise ValueError("Unknown log level " + str(level))
+    return value
+
+
+def format_fields(values):
+    return " ".join(key + "=" + (json.dumps(value) if isinstance(value, str) and (" " in value or not value) else str(value))
+                    for key, value in values.items())
+
+
+class ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        text = super().format(record)
+        values = getattr(record, "fields", None)
+        return text + "  " + format_fields(values) if values else text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Keeps the last RING_SIZE records, an error record dumps them
+class RingHandler(logging.Handler):
+    def __init__(self, size):
+        super().__init__(logging.DEBUG)
+        self.records = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        self.records.append(record)
+        if record.levelno >= logging.ERROR:
+            if _last_dump is None or time.monotonic() - _last_dump >= DUMP_MIN_SECONDS:
+                try:
+                    dump(record.getMessage()[:80])
+                except OSError as ex:
+                    sys.stderr.write("Could not dump the log ring buffer: " + str(ex) + "\n")
+
+
+def _add_handler(handler):
+    _logger.addHandler(handler)
+    logging.getLogger().addHandler(handler)      # Warnings of requests, urllib3 and the like
+
+
+def _remove_handler(handler):
+    if handler is None:
+        return
+    _logger.removeHandler(handler)
+    logging.getLogger().removeHandler(handler)
+    handler.close()
+
+
+# Debug records are only created when the ring buffer or a handler takes them
+def _apply_levels():
+    global _ring
+    _console.setLevel(LEVEL)
+    if _file is not None:
+        _file.setLevel(LEVEL)
+    if RING_SIZE > 0 and (_ring is None or _ring.records.maxlen != RING_SIZE):
+        _remove_handler(_ring)
+        _ring = RingHandler(RING_SIZE)
+        _add_handler(_ring)
+    elif RING_SIZE <= 0 and _ring is not None:
+        _remove_handler(_ring)
+        _ring = None
+    _logger.setLevel(logging.DEBUG if _ring is not None else LEVEL)
+
+
+# A crash of the script is logged, and so dumps the ring buffer, before the interpreter exits
+def _log_uncaught(exc_type, exc, traceback):
+    if issubclass(exc_type, KeyboardInterrupt):
+        sys.__excepthook__(exc_type, exc, traceback)
+        return
+    _logger.critical("Uncaught exception, exiting.", exc_info=(exc_type, exc, traceback))
+
+
+def _setup():
+    global _console
+    _logger.propagate = False               # Handled here, the root logger only gets third-party records
+    logging.getLogger().setLevel(logging.WARNING)
+    _console = logging.StreamHandler(sys.stdout)
+    _console.setFormatter(ConsoleFormatter())
+    _add_handler(_console)
+    _apply_levels()
+    sys.excepthook = _log_uncaught
+
+
+_setup()
@@ -0,0 +1,102 @@
+### Job scheduler for the report loop.
+# Jobs are declared with a daily time ("14:00") or an interval aligned to midnight (every 60 minutes -> hh:00).
+# The scheduler sleeps until the next due instant instead of polling, runs one job at a time, and when several
+# jobs share an instant only the highest priority one runs (e.g. the 14:00 daily report replaces the 14:00 hourly check).
+#
+# Catch up: slots that passed while a job was running, or while the clock jumped, are not lost. For each job only its
+# latest missed slot is run, in time order, and only if it is no older than the job's catch_up_minutes.
+import datetime
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import run_log
+
+log = run_log.get_logger("scheduler")
+
+MAX_SLEEP                   = 300           # Seconds, re-check the wall clock at least this often (NTP adjustments)
+
+
+@dataclass
+class Job:
+    name: str
+    action: Callable                        # Called with the slot time formatted as "hh:mm"
+    at: Optional[str] = None                # Daily at "hh:mm"
+    every_minutes: Optional[int] = None     # Or every N minutes, aligned to midnight
+    priority: int = 0                       # Higher wins when jobs share a slot
+    catch_up_minutes: int = 60              # Missed slots older than this are skipped
+
+    # Returns the slots of this job in (start, end]
+    def get_slots(self, start, end):
+        slots = []
+        day = datetime.datetime.combine(start.date(), datetime.time())
+        while day <= end:
+            if self.at is not None:
+                hour, minute = self.at.split(":")
+                candidates = [day.replace(hour=int(hour), minute=int(minute))]
+            else:
+                candidates = [day + datetime.timedelta(minutes=m) for m in range(0, 24 * 60, self.every_minutes)]
+            slots.extend(slot for slot in candidates if start < slot <= end)
+            day += datetime.timedelta(days=1)
+        return slots
+
+    def get_next_slot(self, after):
+        return self.get_slots(after, after + datetime.timedelta(days=2))[0]
+
+
+class Scheduler:
+    def __init__(self, jobs, now=datetime.datetime.now, sleep=time.sleep):
+        self.jobs = jobs
+        self.now = now
+        self.sleep = sleep
+
+    # Slots in (start, end] as a time ordered list of (slot, job), keeping only the highest priority job per slot.
+    def get_due(self, start, end):
+        winners = {}
+        for job in self.jobs:
+            for slot in job.get_slots(start, end):
+                if slot not in winners or job.priority > winners[slot].priority:
+                    winners[slot] = job
+        return sorted(winners.items(), key=lambda item: item[0])
+
+    def get_next(self, after):
+        return min((job.get_next_slot(after), -job.priority, index) for index, job in enumerate(self.jobs))[0]
+
+    # Returns the (slot, job) pairs to run for the slots in (start, end], with missed slots coalesced per job.
+    def plan(self, start, end):
+        latest = {}
+        for slot, job in self.get_due(start, end):
+            latest[job.name] = (slot, job)
+        runs = []
+        for slot, job in sorted(latest.values(), key=lambda item: item[0]):
+            if end - slot > datetime.timedelta(minutes=job.catch_up_minutes):
+                log.warning("Skipping " + job.name + " for " + slot.strftime("%H:%M") + ", missed by more than "
+                            + str(job.catch_up_minutes) + " minutes.")
+                continue
+            runs.append((slot, job))
+        return runs
+
+    # Run one pass: wait for the next slot, then run everything that is due. Returns the new checked-up-to time.
+    def run_pending(self, checked_until):
+        now = self.now()
+        if now < checked_until:                             # Clock went backwards, do not replay slots
+            checked_until = now
+        if not self.get_due(checked_until, now):
+            wait = (self.get_next(now) - now).total_seconds()
+            self.sleep(min(max(wait, 0.5), MAX_SLEEP))
+            return checked_until
+        for slot, job in self.plan(checked_until, now):
+            formatted_time = slot.strftime("%H:%M")
+            late = (self.now() - slot).total_seconds()
+            if late > 60:
+                log.warning("Running " + job.name + " for " + formatted_time + ", " + str(int(late // 60)) + " minutes late.")
+            try:
+                job.action(formatted_time)
+            except Exception:
+                log.exception(job.name + " for " + formatted_time + " failed.")     # Dumps the log ring buffer
+        return now
+
+    def run_forever(self):
+        checked_until = self.now()                          # Slots before start up are not caught up
+        while True:
+            checked_until = self.run_pending(checked_until)
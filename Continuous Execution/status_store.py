@@ -0,0 +1,152 @@
+### SQLite history of unit statuses, replaces data_dump/status.json.
+# Every run adds one row to `runs` and one row per unit to `unit_status`.
+# The previous run's statuses (used by checkUnitStatus) are read with a single primary-key lookup,
+# and per-unit history is indexed by (unit, run_at), so lookups stay fast as the table grows.
+# `unit_stability` keeps one row per unit (first run, last run not online) for adaptive polling, updated by every
+# run instead of being computed from the whole history on every check.
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import run_log
+
+log = run_log.get_logger("status_store")
+
+DB_FILE                     = "data_dump/status_history.db"
+LEGACY_STATUS_FILE          = "data_dump/status.json"
+# Days of history kept (HISTORY_RETENTION_DAYS), 0 keeps everything
+RETENTION_DAYS              = 400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_at          INTEGER NOT NULL,       -- epoch milliseconds
+    system          TEXT,                   -- VFT / MADs
+    formatted_time  TEXT                    -- hh:mm slot of the run
+);
+CREATE TABLE IF NOT EXISTS unit_status (
+    run_id              INTEGER NOT NULL REFERENCES runs(id),
+    unit                TEXT NOT NULL,
+    run_at              INTEGER NOT NULL,
+    platform_status     TEXT NOT NULL,      -- online / partial / offline / error
+    dataplicity_status  TEXT,
+    latency_ms          INTEGER,            -- age of the last datapoint when the unit was queried
+    remarks             TEXT,
+    PRIMARY KEY (run_id, unit)
+);
+CREATE INDEX IF NOT EXISTS unit_status_unit_run_at ON unit_status (unit, run_at);
+CREATE INDEX IF NOT EXISTS runs_run_at ON runs (run_at);
+-- One row per unit, kept up to date by store_run so adaptive polling does not scan the history
+CREATE TABLE IF NOT EXISTS unit_stability (
+    unit                TEXT PRIMARY KEY,
+    first_run_at        INTEGER NOT NULL,   -- first run of the unit still in the history
+    last_unstable_at    INTEGER             -- last run in which the unit was not online, NULL if none
+);
+"""
+
+
+def configure(retention_days=RETENTION_DAYS):
+    global RETENTION_DAYS
+    RETENTION_DAYS = int(retention_days)
+
+
+def _connect():
+    new_db = not os.path.exists(DB_FILE)
+    os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
+    conn = sqlite3.connect(DB_FILE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")            # Fewer fsyncs on the SD card, still safe with WAL
+    has_stability = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unit_stability'").fetchone()
+    conn.executescript(_SCHEMA)
+    if new_db:
+        _import_legacy_status(conn)
+    if not has_stability:
+        _fill_unit_stability(conn)
+    return conn
+
+
+# Builds unit_stability from the history, once, for databases written before the table existed.
+def _fill_unit_stability(conn):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO unit_stability (unit, first_run_at, last_unstable_at)"
+            " SELECT unit, MIN(run_at), MAX(CASE WHEN platform_status != 'online' THEN run_at END) FROM unit_status GROUP BY unit"
+        )
+
+
+# Seed the history with the last snapshot written by the old status.json store, so the first run still compares.
+def _import_legacy_status(conn):
+    if not os.path.exists(LEGACY_STATUS_FILE):
+        return
+    try:
+        with open(LEGACY_STATUS_FILE) as infile:
+            statuses = json.load(infile)
+    except ValueError:
+        return
+    run_at = int(os.path.getmtime(LEGACY_STATUS_FILE) * 1000)
+    with conn:
+        run_id = conn.execute("INSERT INTO runs (run_at, system) VALUES (?, ?)", (run_at, "status.json")).lastrowid
+        conn.executemany(
+            "INSERT INTO unit_status (run_id, unit, run_at, platform_status) VALUES (?, ?, ?, ?)",
+            [(run_id, unit, run_at, status) for unit, status in statuses.items()],
+        )
+    log.info("Imported " + str(len(statuses)) + " unit statuses from " + LEGACY_STATUS_FILE)
+    _fill_unit_stability(conn)
+
+
+# rows: list of (unit, platform status, dataplicity status, latency of last datapoint in ms or None, remarks)
+def store_run(system, formatted_time, rows):
+    run_at = int(time.time() * 1000)
+    with closing(_connect()) as conn, conn:
+        run_id = conn.execute(
+            "INSERT INTO runs (run_at, system, formatted_time) VALUES (?, ?, ?)", (run_at, system, formatted_time)
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO unit_status (run_id, unit, run_at, platform_status, dataplicity_status, latency_ms, remarks)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(run_id, unit, run_at) + tuple(values) for unit, *values in rows],
+        )
+        conn.executemany(
+            "INSERT INTO unit_stability (unit, first_run_at, last_unstable_at) VALUES (?, ?, ?)"
+            " ON CONFLICT (unit) DO UPDATE SET last_unstable_at = COALESCE(excluded.last_unstable_at, last_unstable_at)",
+            [(unit, run_at, None if platform_status == "online" else run_at) for unit, platform_status, *_ in rows],
+        )
+        if RETENTION_DAYS > 0:
+            _remove_expired_runs(conn, run_at - RETENTION_DAYS * 24 * 60 * 60 * 1000)
+    return run_id
+
+
+# Returns {unit: platform status} from the latest run, like the old status.json.
+def get_previous_status():
+    with closing(_connect()) as conn:
+        rows = conn.execute(
+            "SELECT unit, platform_status FROM unit_status WHERE run_id = (SELECT MAX(id) FROM runs)"
+        ).fetchall()
+    return dict(rows)
+
+
+def _remove_expired_runs(conn, cutoff):
+    first_kept = conn.execute("SELECT MIN(id) FROM runs WHERE run_at >= ?", (cutoff,)).fetchone()[0]
+    if first_kept is None:
+        return
+    removed = conn.execute("DELETE FROM unit_status WHERE run_id < ?", (first_kept,)).rowcount
+    conn.execute("DELETE FROM runs WHERE id < ?", (first_kept,))
+    if removed:                             # unit_stability only describes the history that is kept
+        first_run_at = conn.execute("SELECT run_at FROM runs WHERE id = ?", (first_kept,)).fetchone()[0]
+        conn.execute("DELETE FROM unit_stability WHERE NOT EXISTS (SELECT 1 FROM unit_status WHERE unit_status.unit = unit_stability.unit)")
+        conn.execute("UPDATE unit_stability SET last_unstable_at = NULL WHERE last_unstable_at < ?", (first_run_at,))
+        conn.execute(
+            "UPDATE unit_stability SET first_run_at = (SELECT MIN(run_at) FROM unit_status WHERE unit_status.unit = unit_stability.unit)"
+            " WHERE first_run_at < ?",
+            (first_run_at,),
+        )
+
+
+# Returns {unit: (run_at of the unit's last run that was not online or None, run_at of its first run or None)}, epoch ms.
+def get_unit_stability(units):
+    with closing(_connect()) as conn:
+        rows = conn.execute("SELECT unit, last_unstable_at, first_run_at FROM unit_stability").fetchall()
+    known = {unit: (last_unstable_at, first_run_at) for unit, last_unstable_at, first_run_at in rows}
+    return {unit: known.get(unit, (None, None)) for unit in units}
@@ -0,0 +1,38 @@
+### Cache of recent gateway results, shared by the hourly, validation and daily runs.
+# Keyed by gateway id. A run reuses a gateway's last successful data_dump_index result while it is younger than
+# TTL_SECONDS, and only queries the gateways that are stale or missing. The unit is still classified again with the
+# current Dataplicity state, against the time the result was fetched.
+# Only the fields the status check uses are kept (newest record and total_entries), not the whole page of logs.
+import threading
+
+# Age up to which a gateway result is reused (CACHE_TTL_MINUTES), 0 disables the cache
+TTL_SECONDS                 = 0
+
+_entries = {}                               # key: gateway id, value: (fetched_at in epoch ms, json summary)
+_lock = threading.Lock()
+
+
+def configure(ttl_minutes=TTL_SECONDS / 60):
+    global TTL_SECONDS
+    TTL_SECONDS = float(ttl_minutes) * 60
+
+
+# Returns (fetched_at, json summary) if the gateway has a result younger than max_age seconds (TTL_SECONDS by default)
+# at now (epoch ms), else None.
+def get(gateway_id, now, max_age=None):
+    if max_age is None:
+        max_age = TTL_SECONDS
+    if max_age <= 0:
+        return None
+    with _lock:
+        entry = _entries.get(gateway_id)
+    if entry is None or now - entry[0] > max_age * 1000:
+        return None
+    return entry
+
+
+# Results are kept even with the TTL disabled, adaptive polling (see cadence) reuses them for units that are not due.
+def put(gateway_id, fetched_at, json_dump):
+    summary = {"data_dumps": json_dump["data_dumps"][:1], "total_entries": json_dump.get("total_entries")}
+    with _lock:
+        _entries[gateway_id] = (fetched_at, summary)
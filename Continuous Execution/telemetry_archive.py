@@ -0,0 +1,91 @@
+### Append-only archive of raw gateway responses.
+# Records are appended as compact JSON lines to a gzip'd segment per day: archive/telemetry-YYYYMMDD-NN.jsonl.gz
+# A segment is rotated to the next NN once it reaches MAX_SEGMENT_BYTES, and segments older than
+# RETENTION_DAYS are deleted. Each run appends one gzip member, so segments can be read with gzip.open / zcat.
+import datetime
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+import run_log
+
+log = run_log.get_logger("archive")
+
+# Segment size and retention of the archive (ARCHIVE_* rows)
+ARCHIVE_DIR                 = "archive"
+MAX_SEGMENT_BYTES           = 64 * 1024 * 1024
+RETENTION_DAYS              = 30
+
+_SEGMENT_NAME = re.compile(r"telemetry-(\d{8})-(\d+)\.jsonl\.gz$")
+_lock = threading.Lock()
+_segment = None                             # (path, gzip file) of the open segment
+_segment_date = None
+
+
+def configure(max_segment_mb=MAX_SEGMENT_BYTES / (1024 * 1024), retention_days=RETENTION_DAYS):
+    global MAX_SEGMENT_BYTES, RETENTION_DAYS
+    MAX_SEGMENT_BYTES = int(float(max_segment_mb) * 1024 * 1024)
+    RETENTION_DAYS = int(retention_days)
+
+
+# fetched_at is in epoch milliseconds, like the to_date sent to the platform
+def append(gateway_id, unit_name, fetched_at, response_json):
+    record = {"gateway_id": gateway_id, "unit": unit_name, "fetched_at": fetched_at, "response": response_json}
+    line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+    with _lock:
+        outfile = _get_segment()
+        outfile.write(line)
+
+
+# Flush the open segment and apply the age-based retention. Called at the end of each run.
+def close():
+    global _segment
+    with _lock:
+        if _segment is not None:
+            _segment[1].close()
+            _segment = None
+        _remove_expired_segments()
+
+
+def _get_segment():
+    global _segment, _segment_date
+    today = datetime.date.today().strftime("%Y%m%d")
+    if _segment is not None and _segment_date == today and os.path.getsize(_segment[0]) < MAX_SEGMENT_BYTES:
+        return _segment[1]
+    if _segment is not None:
+        _segment[1].close()
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # Continue today's last segment unless it is full
+    number = 0
+    for filename in os.listdir(ARCHIVE_DIR):
+        match = _SEGMENT_NAME.match(filename)
+        if match and match.group(1) == today:
+            number = max(number, int(match.group(2)))
+    path = _get_segment_path(today, number)
+    if os.path.exists(path) and os.path.getsize(path) >= MAX_SEGMENT_BYTES:
+        path = _get_segment_path(today, number + 1)
+
+    _segment = (path, gzip.open(path, "ab"))
+    _segment_date = today
+    return _segment[1]
+
+
+def _get_segment_path(date, number):
+    return os.path.join(ARCHIVE_DIR, "telemetry-" + date + "-" + str(number).zfill(2) + ".jsonl.gz")
+
+
+def _remove_expired_segments():
+    if not os.path.isdir(ARCHIVE_DIR):
+        return
+    cutoff = time.time() - RETENTION_DAYS * 24 * 60 * 60
+    for filename in os.listdir(ARCHIVE_DIR):
+        path = os.path.join(ARCHIVE_DIR, filename)
+        if _SEGMENT_NAME.match(filename) and os.path.getmtime(path) < cutoff:
+            try:
+                os.unlink(path)
+            except OSError as e:
+                log.warning('Failed to delete %s. Reason: %s' % (path, e))
@@ -0,0 +1,55 @@
+### Check of ADAPTIVE_POLLING together with CACHE_TTL_MINUTES against test/mock_platform.py.
+# Every unit has a result in the sweep cache well within CACHE_TTL_MINUTES. Units without history poll every
+# POLL_MINUTES, so the ones with a result older than half of that are due and the others are not:
+# 1. Due units are queried on the mock platform even though the cache TTL would still serve them.
+# 2. Units that are not due are served from the cache.
+# 3. Only the queries made count against the request budget.
+# Run from "Continuous Execution": python3 test/adaptive_cache_check.py
+import os
+import shutil
+import sys
+import tempfile
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+sys.path.insert(0, TEST_DIR)
+
+import benchmark_run
+import mock_platform
+
+UNITS = 20
+CACHE_TTL_MINUTES = 60
+
+
+def check(name, passed):
+    print(("PASS " if passed else "FAIL ") + name)
+    return passed
+
+
+if __name__ == "__main__":
+    platform = mock_platform.MockPlatform(units=UNITS).start()
+    os.environ.update(platform.get_environment())
+    work_dir = tempfile.mkdtemp(prefix="unit_status_adaptive_")
+    os.chdir(work_dir)
+    os.makedirs("data_dump")
+    results = []
+    try:
+        data_fields = dict(benchmark_run.DATA_FIELDS, ADAPTIVE_POLLING=True, CACHE_TTL_MINUTES=CACHE_TTL_MINUTES, POLL_MINUTES=15)
+        benchmark_run.write_config(UNITS, 1, 0, data_fields)      # No email is sent, SMTP port unused
+        import unit_status
+
+        now = unit_status.get_current_time()
+        keys = list(platform.fleet.get_units())
+        due = set(keys[::2])
+        for key in keys:                    # 10 min old results are due at a 15 min interval, 1 min old ones are not
+            unit_status.sweep_cache.put(key, now - (10 if key in due else 1) * 60 * 1000, {"data_dumps": [], "total_entries": 0})
+
+        unit_status.generate_report(formatted_time="15:00", isBlockEmail=True)
+        queried = platform.stats["data_dumps"]
+        results.append(check("due units queried despite a fresh cache entry", queried == len(due)))
+        results.append(check("units not due served from the cache", len(unit_status.CACHED_UNITS) == UNITS - len(due)))
+        results.append(check("budget counts the queries made", len(unit_status.cadence._polls) == queried))
+    finally:
+        os.chdir(TEST_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if all(results) else 1)
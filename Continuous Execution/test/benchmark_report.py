@@ -0,0 +1,106 @@
+### Benchmark of the unit_status.docx table rendering.
+# Renders 100, 1,000 and 10,000 unit rows with the cell-by-cell python-docx path the report used to take and with
+# report_docx.render_report, checks that both give the same word/document.xml, and prints the render times.
+# The cell-by-cell path is quadratic (every row.cells lists the cells of the whole table), so it is skipped
+# above PER_CELL_MAX_ROWS.
+# Run from "Continuous Execution": python3 test/benchmark_report.py
+import io
+import os
+import random
+import sys
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from docx import Document
+from docx.oxml.shared import qn
+from docx.oxml.xmlchemy import OxmlElement
+
+import report_docx
+
+ROW_COUNTS = [100, 1000, 10000]
+PER_CELL_MAX_ROWS = 1000
+STATUSES = ["online", "partial", "offline", "error"]
+DATAPLICITY = ["online", "offline", "error"]
+REMARKS = ["", "Testing and maintenance - VSUN", "No SIM\nLikely a server issue. Refresh the unit's logs data page on platform.",
+           "\nDevice is disconnected from dataplicity.", " Not Yet Online", "Tab\tseparated & <escaped>"]
+
+
+# The previous per-row rendering from generate_report
+def _set_cell_background(cell, fill, color = None, val = None):
+    cell_properties = cell._element.tcPr
+    if cell_properties.xpath("w:shd"): # exists existing shading
+        cell_shading = cell_properties.xpath("w:shd")[0]
+    else: # add new w:shd element
+        cell_shading = OxmlElement("w:shd")
+    if fill:
+        cell_shading.set(qn("w:fill"), fill)
+    cell_properties.append(cell_shading)
+
+def render_per_cell(path, system, rows):
+    document = Document()
+    document.add_heading("Unit Status", 0)
+    table = document.add_table(rows=1, cols=5)
+    heading_cells = table.rows[0].cells
+    heading_cells[0].text = "Unit Name"
+    heading_cells[1].text = system
+    heading_cells[2].text = "Dataplicity"
+    heading_cells[3].text = "Location"
+    heading_cells[4].text = "Remarks"
+    for unit, unit_status_platform, unit_status_dataplicity, location, remark in rows:
+        cells = table.add_row().cells
+        if unit_status_platform == "online":
+            _set_cell_background(cells[1], "CEEDD0")
+        elif unit_status_platform == "offline":
+            _set_cell_background(cells[1], fill="F6CACF")
+        elif unit_status_platform == "partial":
+            _set_cell_background(cells[1], fill="FBEBA6")
+        elif unit_status_platform == "error":
+            _set_cell_background(cells[1], fill="FF0000")
+
+        if unit_status_dataplicity == "online":
+            _set_cell_background(cells[2], "CEEDD0")
+        elif unit_status_dataplicity == "offline":
+            _set_cell_background(cells[2], fill="F6CACF")
+        elif unit_status_platform == "partial":
+            _set_cell_background(cells[2], fill="FBEBA6")
+        cells[0].text = unit
+        cells[1].text = unit_status_platform
+        cells[2].text = unit_status_dataplicity
+        cells[3].text = location
+        cells[4].text = remark
+    table.style = "Table Grid"
+    document.save(path)
+
+
+def get_rows(count):
+    rng = random.Random(count)
+    return [
+        ("Unit " + str(i), rng.choice(STATUSES), rng.choice(DATAPLICITY), "SG - Site " + str(i % 17), rng.choice(REMARKS))
+        for i in range(count)
+    ]
+
+
+def render(renderer, rows):
+    outfile = io.BytesIO()
+    start = time.perf_counter()
+    renderer(outfile, "VFT", rows)
+    elapsed = time.perf_counter() - start
+    with zipfile.ZipFile(outfile) as docx_zip:
+        return elapsed, docx_zip.read("word/document.xml")
+
+
+if __name__ == "__main__":
+    print("rows".rjust(8) + "per cell (s)".rjust(16) + "bulk (s)".rjust(12) + "speed up".rjust(12) + "  identical")
+    for count in ROW_COUNTS:
+        rows = get_rows(count)
+        bulk_time, bulk_xml = render(report_docx.render_report, rows)
+        if count > PER_CELL_MAX_ROWS:
+            print(str(count).rjust(8) + "skipped".rjust(16) + ("%.3f" % bulk_time).rjust(12) + "-".rjust(12) + "  -")
+            continue
+        per_cell_time, per_cell_xml = render(render_per_cell, rows)
+        print(
+            str(count).rjust(8) + ("%.3f" % per_cell_time).rjust(16) + ("%.3f" % bulk_time).rjust(12)
+            + ("%.1fx" % (per_cell_time / bulk_time)).rjust(12) + "  " + str(per_cell_xml == bulk_xml)
+        )
@@ -0,0 +1,301 @@
+### End-to-end benchmark of generate_report against test/mock_platform.py.
+# For every fleet size the mock platform and the SMTP stub run in their own processes, and the 14:00 daily report is
+# generated in a child process, in a temporary working directory with a config snapshot listing the mock fleet.
+# Wall time, CPU time and peak RSS are recorded for every phase of the run (configuration, auth, dataplicity,
+# gateway sweep, classification, render, dump cleanup, history, email, see unit_status.mark_phase), along with the
+# import time and the time the outbox took to deliver the emails. Results are saved as JSON in benchmark_results/.
+# --compare with an earlier results file prints the change per phase and exits with 1 when a phase got slower by
+# more than --threshold, to catch regressions before deploying to the boards.
+# Run from "Continuous Execution": python3 test/benchmark_run.py [--sizes 10 100] [--compare benchmark_results/x.json]
+import argparse
+import collections
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.dirname(TEST_DIR)
+sys.path.insert(0, SOURCE_DIR)
+sys.path.insert(0, TEST_DIR)
+
+import mock_platform
+
+SIZES = [10, 100, 1000, 10000]
+RESULTS_DIR = os.path.join(TEST_DIR, "benchmark_results")
+NOISE_SECONDS = 0.05                        # Phases changing by less than this are not reported as regressions
+
+# data_sheet of the benchmark config, --field NAME=VALUE overrides or adds rows
+DATA_FIELDS = {
+    "WITHIN_HOURS": 1,
+    "WITHIN_DAYS": 1,
+    "LOGS_DISPLAY_PAGE_SIZE": 1000,
+    "LOGS_DISPLAY_PAGE_NUMBER": 1,
+    "RUN_DEADLINE_SECONDS": 3600,           # Measure the whole sweep rather than the default deadline
+}
+
+
+#======================= Child: one fleet size =======================#
+# Peak RSS of the process between two take_peak() calls, sampled from /proc/self/statm
+class RssSampler(threading.Thread):
+    def __init__(self, interval=0.005):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak = self.get_rss()
+
+    def get_rss(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self.page_size
+        except OSError:                     # No /proc, fall back to the peak of the whole process
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, self.get_rss())
+            time.sleep(self.interval)
+
+    def take_peak(self):
+        current = self.get_rss()
+        peak = max(self.peak, current)
+        self.peak = current
+        return peak
+
+
+def write_config(size, seed, smtp_port, data_fields):
+    import config_loader
+    units = mock_platform.Fleet(size, seed=seed).get_units()
+    config = config_loader.PlatformConfig(
+        account_login={"email": "benchmark@example.com", "password": "benchmark"},
+        dataplicity_login={"email": "benchmark@example.com", "password": "benchmark"},
+        within_hours=data_fields["WITHIN_HOURS"],
+        within_days=data_fields["WITHIN_DAYS"],
+        logs_display_page_size=data_fields["LOGS_DISPLAY_PAGE_SIZE"],
+        logs_display_page_number=data_fields["LOGS_DISPLAY_PAGE_NUMBER"],
+        smtp_server="127.0.0.1",
+        port=smtp_port,
+        sender_email="benchmark@example.com",
+        email_api_key="benchmark",
+        recipients_iot_team=["iot@example.com"],
+        recipients_everyone=["everyone@example.com"],
+        units={"daily_report_units_sheet": units, "hourly_report_units_sheet": units},
+        data_fields=data_fields,
+        email_fields={"SMTP_SSL": False},
+    )
+    # Same layout as config_loader.compile_config, the script loads it as a snapshot-only deployment
+    snapshot = {"version": config_loader.SNAPSHOT_VERSION, "source": {"mtime_ns": 0, "size": 0, "sha1": ""}, "config": asdict(config)}
+    for name in ("units", "unit_thresholds"):
+        snapshot["config"][name] = {sheet: [[key] + list(values) for key, values in rows.items()] for sheet, rows in getattr(config, name).items()}
+    with open(config_loader.get_snapshot_path("vft_config.xlsx"), "w") as outfile:
+        json.dump(snapshot, outfile)
+
+
+def run_child(args):
+    work_dir = tempfile.mkdtemp(prefix="unit_status_benchmark_")
+    os.chdir(work_dir)
+    os.makedirs("data_dump")
+    sampler = RssSampler()
+    sampler.start()
+    try:
+        write_config(args.child, args.seed, args.smtp_port, get_data_fields(args.field))
+        start = (time.monotonic(), time.process_time())
+        import unit_status
+        import_time = {"phase": "import", "wall_s": time.monotonic() - start[0], "cpu_s": time.process_time() - start[1],
+                       "peak_rss_mb": sampler.take_peak() / 2 ** 20}
+
+        rss_peaks = []
+        mark_phase = unit_status.mark_phase
+        def mark_phase_with_rss(phase):
+            count = len(unit_status.RUN_TIMING)
+            mark_phase(phase)
+            if len(unit_status.RUN_TIMING) > count:
+                rss_peaks.append(sampler.take_peak())
+        unit_status.mark_phase = mark_phase_with_rss
+
+        runs = []
+        for _ in range(args.runs):
+            rss_peaks.clear()
+            sampler.take_peak()
+            start = (time.monotonic(), time.process_time())
+            unit_status.generate_report(formatted_time=unit_status.DAILY_EMAIL_TIME)
+            phases = [
+                {"phase": phase, "wall_s": wall, "cpu_s": cpu, "peak_rss_mb": rss / 2 ** 20}
+                for (phase, wall, cpu), rss in zip(unit_status.RUN_TIMING, rss_peaks)
+            ]
+            runs.append({
+                "phases": phases,
+                "total_wall_s": time.monotonic() - start[0],
+                "total_cpu_s": time.process_time() - start[1],
+                "peak_rss_mb": max(phase["peak_rss_mb"] for phase in phases),
+                "statuses": dict(collections.Counter(unit_status.status_store.get_previous_status().values())),
+            })
+
+        start = time.monotonic()
+        while unit_status.mailer.get_queue_size() and time.monotonic() - start < 60:
+            time.sleep(0.01)
+        result = {"size": args.child, "import": import_time, "runs": runs, "email_delivery_s": time.monotonic() - start,
+                  "emails_left": unit_status.mailer.get_queue_size()}
+        with open(args.result, "w") as outfile:
+            json.dump(result, outfile)
+    finally:
+        os.chdir(SOURCE_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def get_data_fields(overrides):
+    fields = dict(DATA_FIELDS)
+    for override in overrides:
+        name, value = override.split("=", 1)
+        fields[name.strip()] = int(value) if value.strip().isdigit() else value.strip()
+    return fields
+
+
+#======================= Parent: servers and results =======================#
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Starts a server script on a free port, get_arguments(port) gives its command line.
+# Returns (process, port) once it accepts connections.
+def start_server(get_arguments):
+    port = get_free_port()
+    arguments = get_arguments(port)
+    process = subprocess.Popen([sys.executable] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=SOURCE_DIR)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Could not start " + arguments[0])
+
+
+def run_size(args, size, smtp_port):
+    mock, port = start_server(lambda port: [
+        os.path.join(TEST_DIR, "mock_platform.py"), "--port", str(port), "--units", str(size), "--seed", str(args.seed),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms), "--error-rate", str(args.error_rate),
+        "--cold-start-rate", str(args.cold_start_rate), "--payload-fields", str(args.payload_fields),
+    ])
+    result_file = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
+    try:
+        base_url = "http://127.0.0.1:" + str(port)
+        env = dict(os.environ, VFT_BASE_URL=base_url, DATAPLICITY_BASE_URL=base_url, MADS_BASE_URL=base_url)
+        command = [sys.executable, "-W", "ignore", os.path.abspath(__file__), "--child", str(size), "--result", result_file,
+                   "--smtp-port", str(smtp_port), "--runs", str(args.runs), "--seed", str(args.seed)]
+        for field in args.field:
+            command += ["--field", field]
+        child = subprocess.run(command, env=env, stdout=subprocess.DEVNULL if not args.verbose else None)
+        if child.returncode != 0:
+            raise RuntimeError("Benchmark of " + str(size) + " units failed with exit code " + str(child.returncode))
+        with open(result_file) as infile:
+            return json.load(infile)
+    finally:
+        mock.terminate()
+        mock.wait()
+        os.remove(result_file)
+
+
+def print_result(result):
+    print()
+    print(str(result["size"]) + " units, import " + "%.2f s" % result["import"]["wall_s"]
+          + ", email delivery " + "%.2f s" % result["email_delivery_s"])
+    print("phase".ljust(16) + "wall (s)".rjust(10) + "cpu (s)".rjust(10) + "peak rss (MB)".rjust(15))
+    for number, run in enumerate(result["runs"], 1):
+        if len(result["runs"]) > 1:
+            print("run " + str(number))
+        for phase in run["phases"]:
+            print(phase["phase"].ljust(16) + ("%.3f" % phase["wall_s"]).rjust(10) + ("%.3f" % phase["cpu_s"]).rjust(10)
+                  + ("%.1f" % phase["peak_rss_mb"]).rjust(15))
+        print("total".ljust(16) + ("%.3f" % run["total_wall_s"]).rjust(10) + ("%.3f" % run["total_cpu_s"]).rjust(10)
+              + ("%.1f" % run["peak_rss_mb"]).rjust(15) + "  " + json.dumps(run["statuses"]))
+
+
+# Prints the change of every phase against an earlier results file, returns the number of regressions
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as infile:
+        baseline = {result["size"]: result for result in json.load(infile)["results"]}
+    print()
+    print("Compared with " + baseline_path + " (first run of each size)")
+    print("units".rjust(7) + "  " + "phase".ljust(16) + "before (s)".rjust(12) + "after (s)".rjust(12) + "change".rjust(10))
+    regressions = 0
+    for result in results:
+        if result["size"] not in baseline:
+            continue
+        before = {phase["phase"]: phase for phase in baseline[result["size"]]["runs"][0]["phases"]}
+        before["total"] = {"wall_s": baseline[result["size"]]["runs"][0]["total_wall_s"]}
+        after = result["runs"][0]["phases"] + [{"phase": "total", "wall_s": result["runs"][0]["total_wall_s"]}]
+        for phase in after:
+            if phase["phase"] not in before:
+                continue
+            old, new = before[phase["phase"]]["wall_s"], phase["wall_s"]
+            change = (new - old) / old if old > 0 else 0.0
+            slower = new - old > NOISE_SECONDS and change > threshold
+            regressions += slower
+            print(str(result["size"]).rjust(7) + "  " + phase["phase"].ljust(16) + ("%.3f" % old).rjust(12)
+                  + ("%.3f" % new).rjust(12) + ("%+.0f%%" % (change * 100)).rjust(10) + ("  SLOWER" if slower else ""))
+    return regressions
+
+
+def main(args):
+    smtp, smtp_port = start_server(lambda port: [os.path.join(TEST_DIR, "smtp_stub.py"), str(port)])
+    results = []
+    try:
+        for size in args.sizes:
+            print("Benchmarking " + str(size) + " units...", flush=True)
+            results.append(run_size(args, size, smtp_port))
+            print_result(results[-1])
+    finally:
+        smtp.terminate()
+        smtp.wait()
+
+    output = args.out or os.path.join(RESULTS_DIR, "run-" + time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as outfile:
+        json.dump({
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": {"python": platform.python_version(), "machine": platform.machine(), "system": platform.platform(), "cpus": os.cpu_count()},
+            "options": {key: value for key, value in vars(args).items() if key not in ("child", "result", "out", "compare", "verbose")},
+            "results": results,
+        }, outfile, indent=1)
+    print()
+    print("Results saved to " + output)
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of generate_report against the mock platform.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="fleet sizes to benchmark")
+    parser.add_argument("--runs", type=int, default=1, help="reports generated per size, the first one signs in")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=20, help="mock platform delay of every request")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--cold-start-rate", type=float, default=0.0)
+    parser.add_argument("--payload-fields", type=int, default=4, help="values per record in the mock responses")
+    parser.add_argument("--field", action="append", default=[], help="data_sheet row of the benchmark config, NAME=VALUE")
+    parser.add_argument("--out", help="results file, benchmark_results/run-<time>.json by default")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown of a phase reported as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the output of generate_report")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--smtp-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        run_child(args)
+    else:
+        main(args)
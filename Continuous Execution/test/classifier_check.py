@@ -0,0 +1,113 @@
+### Check of the Logic V2 classification, without any network.
+# 1. classifier.classify_units over every platform x Dataplicity combination of its table, and the WITHIN_HOURS edge
+#    (a record exactly WITHIN_HOURS old is still online, one millisecond older is partial), with per-unit thresholds.
+# 2. run_vft_status with fetch_vft_unit replaced by canned results, for the error rows: a gateway that could not be
+#    read, one that raised, and the per-unit thresholds from UNIT_THRESHOLDS.
+# Run from "Continuous Execution": python3 test/classifier_check.py
+import os
+import shutil
+import sys
+import tempfile
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+import classifier
+
+NOW = 1700000000000                         # fetched_at, epoch ms
+HOUR = 60 * 60 * 1000
+NO_LOGS = float("nan")
+OFFLINE_REMARK = "No logs data in the last 3 days. IoT disconnection."
+
+
+def check(name, passed):
+    print(("PASS " if passed else "FAIL ") + name)
+    return passed
+
+
+# Returns the (status, remarks, latency) of one unit with the unit's remark "r"
+def classify_one(last_timestamp, dataplicity_offline, within_hours=1, within_days=3):
+    return classifier.classify_units([last_timestamp], [NOW], [dataplicity_offline], ["r"], [within_hours], [within_days])[0]
+
+
+def check_table():
+    results = []
+    recent = (NOW - 10 * 60 * 1000) / 1000  # 10 minutes old
+    old = (NOW - 5 * HOUR) / 1000           # Within the fetch window but older than WITHIN_HOURS
+    rows = [
+        ("online, Dataplicity online", classify_one(recent, False), ("online", "r", 10 * 60 * 1000)),
+        ("online, Dataplicity offline", classify_one(recent, True), ("online", "r\nDevice is disconnected from dataplicity.", 10 * 60 * 1000)),
+        ("partial, Dataplicity online", classify_one(old, False), ("partial", "r\nDevice is experiencing data lag.", 5 * HOUR)),
+        ("partial, Dataplicity offline", classify_one(old, True),
+         ("partial", "r\nDevice is disconnected from dataplicity and experiencing data lag?", 5 * HOUR)),
+        ("offline, Dataplicity online", classify_one(NO_LOGS, False), ("offline", OFFLINE_REMARK, None)),
+        ("offline, Dataplicity offline", classify_one(NO_LOGS, True), ("offline", "r", None)),
+    ]
+    for name, result, expected in rows:
+        results.append(check(name, result == expected))
+
+    edge = (NOW - HOUR) / 1000
+    results.append(check("exactly WITHIN_HOURS old is online", classify_one(edge, False)[0] == "online"))
+    results.append(check("1 ms older than WITHIN_HOURS is partial", classify_one(edge - 0.001, False)[0] == "partial"))
+    results.append(check("a newer record than fetched_at is online", classify_one(NOW / 1000 + 60, False)[0] == "online"))
+
+    # Same record, thresholds per unit and a scalar within_days
+    statuses = classifier.classify_units([old] * 3, [NOW] * 3, [False] * 3, ["", "", ""], [1, 5, 6], 2)
+    results.append(check("per-unit WITHIN_HOURS", [status for status, _, _ in statuses] == ["partial", "online", "online"]))
+    statuses = classifier.classify_units([NO_LOGS] * 2, [NOW] * 2, [False] * 2, ["", ""], 1, [2, 7])
+    results.append(check("per-unit WITHIN_DAYS in the offline remark",
+                         [remark for _, remark, _ in statuses] == ["No logs data in the last 2 days. IoT disconnection.",
+                                                                   "No logs data in the last 7 days. IoT disconnection."]))
+    results.append(check("no units", classifier.classify_units([], [], [], [], [], []) == []))
+    return results
+
+
+def check_run_vft_status():
+    import unit_status
+
+    # key: gateway id, value: (unit name, canned fetch_vft_unit result or an exception to raise)
+    recent = (NOW - 2 * HOUR) / 1000
+    fetches = {
+        1: ("Unit A", (NOW, recent, "")),                   # 2 h old: partial at WITHIN_HOURS 1, online at 3
+        2: ("Unit B", (NOW, recent, "")),
+        3: ("Unit C", None),                                # Could not be read
+        4: ("Unit D", KeyError("data_dumps")),              # Unexpected error in the worker
+        5: ("Unit E", (NOW, None, "Served from cache, 5 min old.")),
+    }
+    seen_thresholds = {}
+
+    def fetch_vft_unit(key, unit_name, dataplicity_state, curr_time, start_time, within_hours, max_cache_age=None, generation=None):
+        seen_thresholds[key] = within_hours
+        result = fetches[key][1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    unit_status.fetch_vft_unit = fetch_vft_unit
+    unit_status.WITHIN_HOURS = 1
+    unit_status.WITHIN_DAYS = 3
+    unit_status.UNIT_THRESHOLDS.clear()
+    unit_status.UNIT_THRESHOLDS[2] = (3, None)
+    units = {key: (unit_name, "loc", "r") for key, (unit_name, _) in fetches.items()}
+    status = unit_status.run_vft_status({unit_name: "online" for unit_name, _ in fetches.values()}, units)
+
+    results = []
+    results.append(check("units kept in sheet order", list(status) == ["Unit A", "Unit B", "Unit C", "Unit D", "Unit E"]))
+    results.append(check("per-unit WITHIN_HOURS passed to the fetch", seen_thresholds == {1: 1, 2: 3, 3: 1, 4: 1, 5: 1}))
+    results.append(check("per-unit WITHIN_HOURS in the run", status["Unit A"][0] == "partial" and status["Unit B"][0] == "online"))
+    results.append(check("unreadable gateway is error", status["Unit C"] == ("error", "loc", "r\n" + unit_status.FAILED_RETRIEVAL)))
+    results.append(check("failing fetch is error", status["Unit D"] == ("error", "loc", "r\n" + unit_status.UNEXPECTED_ERROR)))
+    results.append(check("cache note added to the remarks", status["Unit E"] == ("offline", "loc", OFFLINE_REMARK + "\nServed from cache, 5 min old.")))
+    return results
+
+
+if __name__ == "__main__":
+    results = check_table()
+    work_dir = tempfile.mkdtemp(prefix="unit_status_classifier_")
+    os.chdir(work_dir)                      # run_vft_status writes data_dump/transfer_stats.json
+    try:
+        results += check_run_vft_status()
+    finally:
+        os.chdir(TEST_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(0 if all(results) else 1)
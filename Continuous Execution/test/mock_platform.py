@@ -0,0 +1,250 @@
+### Local stand-in for the VFlowTechIoT, Dataplicity and MADs APIs.
+# Serves a synthetic fleet so that run_vft_status, run_dataplicity_status and run_mad_status can run without the live
+# backends or real credentials:
+#   POST /auth/                                   Dataplicity sign-in, {"token": ...}
+#   POST /api/sign-in                             VFlowTechIoT / MADs account sign-in, {"access_token": ...}
+#   POST /api/orgs/<org>/sign-in                  VFlowTechIoT organisation sign-in
+#   GET  /devices/                                Dataplicity devices, [{"name": ..., "online": ...}]
+#   GET  /api/iot_mgmt/orgs/<org>/projects/<project>/gateways/<id>/data_dump_index
+#                                                 newest first page of records between from_date and to_date
+# Gateway ids are 1 to units. Every unit is online, partial (newest record hours to days old) or has no records, and
+# online or offline on Dataplicity, drawn from the seed. Requests can be slowed down (latency_ms + up to jitter_ms),
+# fail with 503 at error_rate, and a cold_start_rate share of the gateways answer 500 to their first query after
+# cold_seconds without one, like VFlowTechIoT does.
+# The script reads its platform addresses from VFT_BASE_URL, DATAPLICITY_BASE_URL and MADS_BASE_URL.
+# Run from "Continuous Execution": python3 test/mock_platform.py --units 1000 --latency-ms 50, then in another shell
+# export the printed variables before starting unit_status.py. The units sheet must list the same gateway ids and
+# names, see get_units().
+import argparse
+import http.server
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+DEFAULT_PORT = 8081
+RECORD_SECONDS = 60                         # A unit with data sends a record every minute
+TOKEN_PREFIX = "mock-"                      # Tokens of any earlier mock server stay valid, like cached tokens of the live platforms
+PAYLOAD_FIELDS = 20                         # Values per record by default, makes a page about as heavy as a real one
+
+_GATEWAY_PATH = re.compile(r"^/api/iot_mgmt/orgs/\d+/projects/\d+/gateways/(\d+)/data_dump_index/?$")
+_ORG_SIGN_IN_PATH = re.compile(r"^/api/orgs/\d+/sign-in/?$")
+
+
+class Fleet:
+    def __init__(self, units, seed=1, online_rate=0.8, partial_rate=0.1, dataplicity_offline_rate=0.1, cold_start_rate=0.0,
+                 payload_fields=PAYLOAD_FIELDS):
+        rng = random.Random(seed)
+        self.payload_fields = payload_fields
+        now = time.time()
+        self.names = {}                     # key: gateway id, value: unit name
+        self.newest = {}                    # key: gateway id, value: epoch seconds of the newest record, None without records
+        self.online = {}                    # key: unit name, value: online on Dataplicity
+        self.cold_prone = set()
+        for gateway_id in range(1, units + 1):
+            name = "Mock Unit " + str(gateway_id).zfill(5)
+            self.names[gateway_id] = name
+            draw = rng.random()
+            if draw < online_rate:
+                self.newest[gateway_id] = now - rng.uniform(0, 30 * 60)
+            elif draw < online_rate + partial_rate:
+                self.newest[gateway_id] = now - rng.uniform(2 * 60 * 60, 3 * 24 * 60 * 60)
+            else:
+                self.newest[gateway_id] = None
+            self.online[name] = rng.random() >= dataplicity_offline_rate
+            if rng.random() < cold_start_rate:
+                self.cold_prone.add(gateway_id)
+
+    # {gateway id: (unit name, location, remarks)}, the shape configure_vft returns
+    def get_units(self):
+        return {gateway_id: (name, "Mock Site " + str(gateway_id % 17), "") for gateway_id, name in self.names.items()}
+
+    # Newest first page of a gateway's records between from_date and to_date (epoch ms)
+    def get_data_dump(self, gateway_id, from_date, to_date, page_size, page_number):
+        newest = self.newest.get(gateway_id)
+        if newest is None:
+            return {"data_dumps": [], "total_entries": 0}
+        # Records are at newest, newest - RECORD_SECONDS, newest - 2 * RECORD_SECONDS, ...
+        first = newest
+        if first * 1000 > to_date:
+            first -= math.ceil((first - to_date / 1000) / RECORD_SECONDS) * RECORD_SECONDS
+        total = int((first - from_date / 1000) // RECORD_SECONDS) + 1 if first * 1000 >= from_date else 0
+        skip = max(0, page_number - 1) * page_size
+        data_dumps = []
+        for index in range(skip, min(total, skip + page_size)):
+            timestamp = first - index * RECORD_SECONDS
+            payload = {"field_" + str(field): round(timestamp % (field + 7), 3) for field in range(self.payload_fields)}
+            data_dumps.append({"id": gateway_id * 1000000 + index, "data": dict(payload, timestamp=timestamp)})
+        return {"data_dumps": data_dumps, "total_entries": total}
+
+
+class MockPlatform(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, units=100, port=0, seed=1, latency_ms=0, jitter_ms=0, error_rate=0.0, cold_start_rate=0.0,
+                 cold_seconds=15 * 60, dataplicity_offline_rate=0.1, payload_fields=PAYLOAD_FIELDS):
+        super().__init__(("127.0.0.1", port), RequestHandler)
+        self.base_url = "http://127.0.0.1:" + str(self.server_address[1])
+        self.fleet = Fleet(units, seed=seed, dataplicity_offline_rate=dataplicity_offline_rate, cold_start_rate=cold_start_rate,
+                           payload_fields=payload_fields)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.cold_seconds = cold_seconds
+        self.last_query = {}                # key: gateway id, value: time.monotonic() of its last query
+        self.stats = {"requests": 0, "sign_ins": 0, "devices": 0, "data_dumps": 0, "errors": 0, "cold_starts": 0, "unauthorized": 0, "bytes": 0}
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    # Serves in a background thread, returns the server
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # Clients closing their keep-alive connections are not errors
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    # Environment of a unit_status.py process that should use this server
+    def get_environment(self):
+        return {"VFT_BASE_URL": self.base_url, "DATAPLICITY_BASE_URL": self.base_url, "MADS_BASE_URL": self.base_url}
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def new_token(self):
+        with self.lock:
+            self.stats["sign_ins"] += 1
+            return TOKEN_PREFIX + str(self.rng.getrandbits(64))
+
+    # Delay of the next request and whether it fails
+    def draw_fault(self):
+        with self.lock:
+            delay = (self.latency_ms + self.rng.uniform(0, self.jitter_ms)) / 1000
+            return delay, self.rng.random() < self.error_rate
+
+    # True if the gateway answers 500 to this query because it has not been queried for a while
+    def is_cold(self, gateway_id):
+        if gateway_id not in self.fleet.cold_prone:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_query.get(gateway_id)
+            self.last_query[gateway_id] = now
+            cold = last is None or now - last > self.cold_seconds
+            if cold:
+                self.stats["cold_starts"] += 1
+        return cold
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urllib.parse.urlsplit(self.path).path
+        if not self.start_request():
+            return
+        if path.rstrip("/") == "/auth":
+            self.send_json(200, {"token": self.server.new_token()})
+        elif path.rstrip("/") == "/api/sign-in" or _ORG_SIGN_IN_PATH.match(path):
+            self.send_json(200, {"access_token": self.server.new_token()})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if not self.start_request():
+            return
+        if not self.is_authorized():
+            self.server.count("unauthorized")
+            self.send_json(401, {"error": "invalid token"})
+            return
+        server = self.server
+        if url.path.rstrip("/") == "/devices":
+            server.count("devices")
+            self.send_json(200, [{"name": name, "online": online} for name, online in server.fleet.online.items()])
+            return
+        match = _GATEWAY_PATH.match(url.path)
+        if match is None:
+            self.send_json(404, {"error": "not found"})
+            return
+        gateway_id = int(match.group(1))
+        if gateway_id not in server.fleet.names:
+            self.send_json(404, {"error": "gateway not found"})
+            return
+        server.count("data_dumps")
+        if server.is_cold(gateway_id):
+            self.send_json(500, {"error": "internal server error"})
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.send_json(200, server.fleet.get_data_dump(
+            gateway_id, int(query.get("from_date", 0)), int(query.get("to_date", time.time() * 1000)),
+            int(query.get("page_size", 10)), int(query.get("page_number", 1)),
+        ))
+
+    # Applies the injected latency and errors, returns False if the request was answered with an error
+    def start_request(self):
+        self.server.count("requests")
+        delay, failed = self.server.draw_fault()
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            self.server.count("errors")
+            self.send_json(503, {"error": "service unavailable"})
+            return False
+        return True
+
+    def is_authorized(self):
+        parts = self.headers.get("Authorization", "").split(" ", 1)
+        return len(parts) == 2 and parts[1].startswith(TOKEN_PREFIX)
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        self.server.count("bytes", len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the VFlowTechIoT, Dataplicity and MADs APIs.")
+    parser.add_argument("--units", type=int, default=100, help="gateways in the fleet, ids 1 to units")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0, help="delay of every request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random extra delay, up to this")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--cold-start-rate", type=float, default=0.0, help="share of gateways answering 500 when cold")
+    parser.add_argument("--cold-seconds", type=float, default=15 * 60, help="idle time after which a gateway is cold")
+    parser.add_argument("--dataplicity-offline-rate", type=float, default=0.1)
+    parser.add_argument("--payload-fields", type=int, default=PAYLOAD_FIELDS, help="values per record")
+    args = parser.parse_args()
+
+    platform = MockPlatform(
+        units=args.units, port=args.port, seed=args.seed, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate, cold_start_rate=args.cold_start_rate, cold_seconds=args.cold_seconds,
+        dataplicity_offline_rate=args.dataplicity_offline_rate, payload_fields=args.payload_fields,
+    )
+    print("Mock platform with " + str(args.units) + " gateways listening on " + platform.base_url)
+    for name, value in platform.get_environment().items():
+        print("export " + name + "=" + value)
+    try:
+        platform.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(platform.stats))
@@ -0,0 +1,88 @@
+### End to end check of the email outbox against test/smtp_stub.py.
+# 1. Two emails are queued while the SMTP server refuses connections: they stay in the outbox with a retry planned.
+# 2. The mailer state is dropped, as after a service restart, and the outbox is delivered over one session.
+# 3. An email to a refused recipient is moved to failed/, and the background worker delivers a queued email.
+# 4. A server that accepts the connection but never answers times out, and the email stays in the outbox.
+# The outbox, the log file and the error dumps are written to a temporary directory.
+# Run from "Continuous Execution": python3 test/outbox_check.py
+import importlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import mailer
+import run_log
+import smtp_stub
+
+
+def get_mailer(outbox_dir, port, timeout=mailer.TIMEOUT):
+    importlib.reload(mailer)                # Fresh module state, only the outbox on disk is kept
+    mailer.OUTBOX_DIR = outbox_dir
+    mailer.configure("127.0.0.1", port, "sender@example.com", "password", use_ssl=False, retry_base_seconds=1, timeout=timeout)
+    return mailer
+
+
+def get_message(subject):
+    return "Subject: " + subject + "\r\nFrom: sender@example.com\r\n\r\nUnit status.\r\n"
+
+
+def check(name, passed):
+    print(("PASS " if passed else "FAIL ") + name)
+    return passed
+
+
+if __name__ == "__main__":
+    work_dir = tempfile.mkdtemp(prefix="unit_status_outbox_")
+    run_log.DUMP_DIR = os.path.join(work_dir, "logs")     # The refused recipient logs an error, which dumps the ring buffer
+    run_log.configure(file=os.path.join(work_dir, "logs", "unit_status.log"))
+    stub = smtp_stub.SMTPStub().start()
+    outbox_dir = os.path.join(work_dir, "outbox")
+    results = []
+
+    outbox = get_mailer(outbox_dir, stub.port)
+    stub.refuse_sessions = 2                # First session and its reconnect
+    outbox.queue(get_message("Hourly"), ["iot@example.com"])
+    outbox.queue(get_message("Daily"), ["everyone@example.com", "iot@example.com"])
+    outbox.deliver()
+    entries = [json.load(open(os.path.join(outbox_dir, name))) for name in sorted(os.listdir(outbox_dir)) if name.endswith(".json")]
+    results.append(check("outage keeps both emails in the outbox", len(entries) == 2 and not stub.messages))
+    results.append(check("retry planned after the outage", all(entry["attempts"] == 1 and entry["next_attempt"] > time.time() for entry in entries)))
+
+    time.sleep(1.1)
+    outbox = get_mailer(outbox_dir, stub.port)
+    sessions = stub.sessions
+    outbox.deliver()
+    results.append(check("outbox delivered after restart", outbox.get_queue_size() == 0 and len(stub.messages) == 2))
+    results.append(check("one SMTP session for the batch", stub.sessions - sessions == 1 and outbox.SESSIONS_OPENED == 1))
+    results.append(check("delivered in queue order", [message[2].split("\r\n")[0] for message in stub.messages] == ["Subject: Hourly", "Subject: Daily"]))
+
+    stub.refuse_recipients.add("nobody@example.com")
+    outbox.queue(get_message("Refused"), ["nobody@example.com"])
+    outbox.deliver()
+    results.append(check("refused email moved to failed/", outbox.get_queue_size() == 0 and len(os.listdir(os.path.join(outbox_dir, "failed"))) == 1))
+
+    outbox.queue(get_message("Background"), ["iot@example.com"])
+    outbox.flush()
+    deadline = time.monotonic() + 5
+    while outbox.get_queue_size() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    results.append(check("background worker delivers the outbox", len(stub.messages) == 3))
+
+    silent = socket.socket()                # Accepted by the kernel, never greeted
+    silent.bind(("127.0.0.1", 0))
+    silent.listen()
+    outbox = get_mailer(os.path.join(work_dir, "silent_outbox"), silent.getsockname()[1], timeout=1)
+    outbox.queue(get_message("Silent"), ["iot@example.com"])
+    start = time.monotonic()
+    outbox.deliver()
+    results.append(check("silent server times out and the email is kept", time.monotonic() - start < 5 and outbox.get_queue_size() == 1))
+    silent.close()
+
+    stub.shutdown()
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,109 @@
+### Local SMTP server standing in for the mail provider.
+# Accepts any login (AUTH PLAIN) and keeps the received emails in memory, no SSL. Set SMTP_SSL to FALSE, the
+# SMTP server to 127.0.0.1 and the port to the stub's in email_sheet to send the status emails here.
+# The next refuse_sessions connections are answered with 421 and closed, and recipients in refuse_recipients are
+# rejected with 550, to try the outbox retries.
+# Run from "Continuous Execution": python3 test/smtp_stub.py [port], prints every email it receives.
+import email
+import socketserver
+import sys
+import threading
+
+DEFAULT_PORT = 2525
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        stub = self.server
+        with stub.lock:
+            stub.sessions += 1
+            refuse = stub.refuse_sessions > 0
+            if refuse:
+                stub.refuse_sessions -= 1
+        if refuse:
+            self.reply("421 Service not available")
+            return
+        self.reply("220 smtp_stub ESMTP")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-smtp_stub\r\n250-AUTH PLAIN\r\n250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 smtp_stub")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "MAIL":
+                sender, recipients = get_address(command), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipient = get_address(command)
+                if recipient in stub.refuse_recipients:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(recipient)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = self.read_data()
+                with stub.lock:
+                    stub.messages.append((sender, recipients, data))
+                if stub.verbose:
+                    print("Received '" + str(email.message_from_string(data)["Subject"]) + "' for " + ", ".join(recipients))
+                self.reply("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline().decode("utf-8", "replace")
+            if line in (".\r\n", ".\n", ""):
+                return "".join(lines)
+            lines.append(line[1:] if line.startswith("..") else line)
+
+    def reply(self, text):
+        self.wfile.write((text + "\r\n").encode("utf-8"))
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, verbose=False):
+        super().__init__(("127.0.0.1", port), SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []                  # (sender, recipients, message string)
+        self.sessions = 0
+        self.refuse_sessions = 0
+        self.refuse_recipients = set()
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+    # Serves in a background thread, returns the stub
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def get_address(command):
+    return command.split(":", 1)[1].split()[0].strip("<>") if ":" in command else ""
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    stub = SMTPStub(port, verbose=True)
+    print("SMTP stub listening on 127.0.0.1:" + str(stub.port))
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
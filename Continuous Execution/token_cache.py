@@ -0,0 +1,109 @@
+### Persistent auth-token cache for the platform sign-ins.
+# Tokens are saved to disk with their expiry so that runs after the first skip the login round trips.
+# A token is refreshed proactively when it is within REFRESH_MARGIN of expiring, or when the platform answers 401.
+# A token the platform still rejects right after signing in is dropped, so the next request signs in again.
+import base64
+import json
+import os
+import threading
+import time
+
+import run_log
+
+log = run_log.get_logger("token_cache")
+
+CACHE_FILE                  = "data_dump/token_cache.json"
+# Fallback token lifetime and renewal margin (TOKEN_* rows)
+LIFETIME                    = 12 * 60 * 60  # Seconds, used when the token does not carry its own expiry (JWT "exp")
+REFRESH_MARGIN              = 5 * 60        # Seconds before expiry at which a token is renewed
+
+_tokens = None                              # key: cache key, value: {"token": str, "expires_at": epoch seconds}
+_lock = threading.Lock()                    # Guards _tokens and the cache file, never held during a sign-in
+_key_locks = {}                             # key: cache key, value: lock held while that key signs in
+
+
+def configure(lifetime=LIFETIME, refresh_margin=REFRESH_MARGIN):
+    global LIFETIME, REFRESH_MARGIN
+    LIFETIME = float(lifetime)
+    REFRESH_MARGIN = float(refresh_margin)
+
+
+# Returns a valid token for key, calling login() (which must return the token string) only if needed.
+# Threads asking for the same key wait for one sign-in, other keys are not blocked by it.
+def get_token(key, login):
+    with _get_key_lock(key):
+        entry = _get_entry(key)
+        if entry and entry["expires_at"] - REFRESH_MARGIN > time.time():
+            return entry["token"]
+        return _renew(key, login)
+
+
+# Called after a 401 with the token that was rejected.
+# If another thread already renewed it, the new token is returned without logging in again. Otherwise the rejected
+# token is dropped before signing in, so a failed sign-in does not leave it in the cache for later requests and runs.
+def refresh(key, login, rejected_token):
+    with _get_key_lock(key):
+        entry = _get_entry(key)
+        if entry and entry["token"] != rejected_token and entry["expires_at"] - REFRESH_MARGIN > time.time():
+            return entry["token"]
+        log.info("Token for " + key.split(":")[0] + " was rejected, signing in again.")
+        invalidate(key, rejected_token)
+        return _renew(key, login)
+
+
+# Drops the cached token of key, or only if it is still token (another thread may have renewed it since).
+def invalidate(key, token=None):
+    with _lock:
+        entry = _load().get(key)
+        if entry is not None and (token is None or entry["token"] == token):
+            del _tokens[key]
+            _save()
+
+
+def _get_key_lock(key):
+    with _lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _get_entry(key):
+    with _lock:
+        return _load().get(key)
+
+
+def _renew(key, login):
+    token = login()
+    with _lock:
+        _load()[key] = {"token": token, "expires_at": _get_expiry(token)}
+        _save()
+    return token
+
+
+# Use the JWT "exp" claim when the token has one, otherwise assume LIFETIME.
+def _get_expiry(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + LIFETIME
+
+
+def _load():
+    global _tokens
+    if _tokens is None:
+        try:
+            with open(CACHE_FILE) as infile:
+                _tokens = json.load(infile)
+        except (OSError, ValueError):
+            _tokens = {}
+    return _tokens
+
+
+def _save():
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    temp_file = CACHE_FILE + ".tmp"
+    # Tokens are credentials, keep the file private to the service user
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as outfile:
+        json.dump(_tokens, outfile)
+    os.replace(temp_file, CACHE_FILE)
@@ -1,29 +1,38 @@
 import json
 import time
-import requests
 import datetime
-import os, shutil
-import pandas as pd
+import os, shutil, sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from os.path import exists
 
-from docx import Document
-from docx.oxml.shared import qn
-from docx.oxml.xmlchemy import OxmlElement
+import http_client
+import json_stream
+import mailer
+import metrics
+import report_formats
+import status_store
+import telemetry_archive
+import cadence
+import classifier
+import config_loader
+import retry
+import run_log
+import scheduler
+import sweep_cache
+import token_cache
 
-import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
-import ssl
+
+log = run_log.get_logger()
 
 ### Global Variables
 MADS_FILE_NAME              = "mads_config.xlsx"
 VFT_FILE_NAME               = "vft_config.xlsx"
 UNITS_SHEET                 = "daily_report_units_sheet"
 HOURLY_UNITS_SHEET          = "hourly_report_units_sheet"
-DATA_SHEET                  = "data_sheet"
-ACCOUNT_SHEET               = "account_sheet"
-EMAIL_SHEET                 = "email_sheet"
 OUTPUT_FILE                 = "unit_status.docx"
 # Account details and fields to be initialized
 DATAPLICITY_LOGIN = {}
@@ -32,6 +41,20 @@ LOGS_DISPLAY_PAGE_SIZE      = "to intialize"
 LOGS_DISPLAY_PAGE_NUMBER    = "to intialize"
 WITHIN_HOURS                = "to intialize"
 WITHIN_DAYS                 = "to intialize"
+MAX_WORKERS                 = 8             # Number of gateways queried in parallel, optional row in data_sheet
+PROBE_MODE                  = False         # Request a single record per gateway instead of a full page, optional row in data_sheet
+STREAM_JSON                 = False         # Decode data_dump_index responses incrementally, optional row in data_sheet
+STREAM_MIN_BYTES            = 1024 * 1024   # With STREAM_JSON, smaller responses are decoded whole and keep their connection, optional row in data_sheet (STREAM_MIN_KB)
+ARCHIVE_MODE                = False         # Keep raw gateway responses in archive/, optional row in data_sheet
+WARMUP_MINUTES              = 10            # Gateways are warmed up this long before the 13:00 and 14:00 reports (0 to disable), optional row in data_sheet
+ADAPTIVE_POLLING            = False         # Hourly checks only query the units that are due, see cadence, optional row in data_sheet
+RUN_DEADLINE_SECONDS        = 600           # Time budget of a run, units not answered by then are reported as error, optional row in data_sheet
+HOURLY_SKIP_UNCHANGED       = False         # No hourly email when no unit went offline or online, optional row in data_sheet
+HOURLY_ATTACHMENT           = "always"      # Report attached to the hourly email: always, changes (only when a unit went offline or online) or never, optional row in data_sheet
+# Platform addresses, the environment variables point the script at another server such as test/mock_platform.py
+VFT_BASE_URL                = os.environ.get("VFT_BASE_URL", "https://backend.vflowtechiot.com")
+DATAPLICITY_BASE_URL        = os.environ.get("DATAPLICITY_BASE_URL", "https://apps.dataplicity.com")
+MADS_BASE_URL               = os.environ.get("MADS_BASE_URL", "https://datakrewtech.com")
 VALIDATION_EMAIL_TIME       = "13:00"
 DAILY_EMAIL_TIME            = "14:00"
 # Email details and authentication
@@ -41,9 +64,34 @@ RECIPIENTS_EVERYONE         = None
 RECIPIENTS_IOT_TEAM         = None
 EMAIL_API_KEY               = None
 PORT                        = None
+REPORT_FORMATS_IOT_TEAM     = ("docx",)     # Report formats sent to RECIPIENTS_IOT_TEAM, optional row in email_sheet
+REPORT_FORMATS_EVERYONE     = ("docx",)     # Report formats sent to RECIPIENTS_EVERYONE, optional row in email_sheet
+
+# key: unit name, value: age in ms of the unit's last datapoint when it was queried, filled by the platform status runs
+LAST_DATAPOINT_LATENCY = {}
+# key: unit id, value: (WITHIN_HOURS, WITHIN_DAYS) of the unit, None where the units sheet leaves the global value
+UNIT_THRESHOLDS = {}
+# key: unit name, value: (seconds, retries) of the unit's VFT requests in the last run, filled by fetch_vft_unit
+UNIT_FETCH_STATS = {}
+# key: unit name, value: age in minutes of the cached result the unit was classified with, see sweep_cache
+CACHED_UNITS = {}
+
+# time.monotonic() by which the current run must stop waiting for units, set by generate_report
+RUN_DEADLINE = None
+# Every gateway sweep (run or warm-up) gets a generation. Workers the sweep stopped waiting for at its deadline keep a
+# stale generation and drop their results instead of writing them into the run's (or the next run's) state.
+SWEEP_GENERATION = 0
+SWEEP_LOCK = threading.Lock()                               # Held while a worker checks its generation and writes results
+SWEEP_LOCAL = threading.local()                             # generation of the sweep the current worker thread belongs to
+# (phase, wall seconds, CPU seconds) of the current run, see mark_phase
+RUN_TIMING = []
+# (time.monotonic(), time.process_time()) when the current phase of the run started, None outside generate_report
+PHASE_START = None
 
 # Error message
 FAILED_RETRIEVAL = "Likely a server issue. Refresh the unit's logs data page on platform."
+DEADLINE_EXCEEDED = "No response before the run deadline, unit was not checked."
+UNEXPECTED_ERROR = "Unexpected error while checking the unit, see the log."
 
 #======================= Configuration =======================#
 # As of June 2023, MADs configuration is not updated to VFT standard.
@@ -53,14 +101,8 @@ def configure_mads():
     configure_data_fields(MADS_FILE_NAME)
     configure_email_fields(MADS_FILE_NAME)
     
-    df = pd.read_excel(io=MADS_FILE_NAME, sheet_name=UNITS_SHEET)
-    df = df.fillna("")
-    df.drop(df.columns[4], axis=1, inplace=True)
-    
-    units = {}
-    for _, row in df.iterrows():
-        units[row[0]] = (row[1], row[2], row[3])
-    return units
+    config = config_loader.load_config(MADS_FILE_NAME)
+    return dict(config.units[UNITS_SHEET])
 
 def configure_vft(isHourly=False):
     configure_account_fields(VFT_FILE_NAME)
@@ -73,53 +115,126 @@ def configure_vft(isHourly=False):
         sheet_to_read = HOURLY_UNITS_SHEET
     else:
         sheet_to_read = UNITS_SHEET
-    df = pd.read_excel(io=VFT_FILE_NAME, sheet_name=sheet_to_read)
-    df = df.fillna("")
-    df.drop(df.columns[4], axis=1, inplace=True)
-    
-    units = {}
-    for _, row in df.iterrows():
-        units[row[0]] = (row[1], row[2], row[3])
-    return units
+    # The workbook is parsed once and cached by config_loader, re-parsed only when the file changes.
+    config = config_loader.load_config(VFT_FILE_NAME)
+    UNIT_THRESHOLDS.clear()
+    UNIT_THRESHOLDS.update(config.unit_thresholds.get(sheet_to_read, {}))
+    return dict(config.units[sheet_to_read])
+
+# Compile the config workbooks into JSON snapshots so that start up does not need pandas.
+# Run with: python3 unit_status.py compile-config
+def compile_configs():
+    for file_name in (VFT_FILE_NAME, MADS_FILE_NAME):
+        try:
+            config_loader.compile_config(file_name)
+            log.info("Compiled " + file_name + " into " + config_loader.get_snapshot_path(file_name))
+        except Exception as ex:
+            log.error("Failed to compile " + file_name + ": " + str(ex))
 
 # These accounts will be used to login into VFlowTechIot.com and dataplicity.com
 def configure_account_fields(PLATFORM_FILE_NAME):
     global ACCOUNT_LOGIN
-    ACCOUNT_LOGIN = {} # dict where keys are email and password
-    
-    df = pd.read_excel(io=PLATFORM_FILE_NAME, sheet_name=ACCOUNT_SHEET)
-    ACCOUNT_LOGIN["email"] = df.iloc[0][1]
-    ACCOUNT_LOGIN["password"] = df.iloc[1][1]
-    DATAPLICITY_LOGIN["email"] = df.iloc[2][1]
-    DATAPLICITY_LOGIN["password"] = df.iloc[3][1]
+    config = config_loader.load_config(PLATFORM_FILE_NAME)
+    ACCOUNT_LOGIN = dict(config.account_login) # dict where keys are email and password
+    DATAPLICITY_LOGIN.update(config.dataplicity_login)
 
 def configure_data_fields(PLATFORM_FILE_NAME):
-    global LOGS_DISPLAY_PAGE_SIZE, LOGS_DISPLAY_PAGE_NUMBER, WITHIN_HOURS, WITHIN_DAYS
-    
-    df = pd.read_excel(io=PLATFORM_FILE_NAME, sheet_name=DATA_SHEET)
-    WITHIN_HOURS = int(df.iloc[0][1])
-    WITHIN_DAYS = int(df.iloc[1][1])
-    LOGS_DISPLAY_PAGE_SIZE = int(df.iloc[2][1])
-    LOGS_DISPLAY_PAGE_NUMBER = int(df.iloc[3][1])
+    global LOGS_DISPLAY_PAGE_SIZE, LOGS_DISPLAY_PAGE_NUMBER, WITHIN_HOURS, WITHIN_DAYS, MAX_WORKERS, PROBE_MODE, STREAM_JSON, STREAM_MIN_BYTES, ARCHIVE_MODE, RUN_DEADLINE_SECONDS, WARMUP_MINUTES, ADAPTIVE_POLLING, HOURLY_SKIP_UNCHANGED, HOURLY_ATTACHMENT
     
+    config = config_loader.load_config(PLATFORM_FILE_NAME)
+    WITHIN_HOURS = config.within_hours
+    WITHIN_DAYS = config.within_days
+    LOGS_DISPLAY_PAGE_SIZE = config.logs_display_page_size
+    LOGS_DISPLAY_PAGE_NUMBER = config.logs_display_page_number
+    # Optional fields, looked up by name so older workbooks without these rows still work.
+    fields = config.data_fields
+    MAX_WORKERS = int(read_optional_field(fields, "MAX_WORKERS", MAX_WORKERS))
+    PROBE_MODE = parse_bool(read_optional_field(fields, "PROBE_MODE", PROBE_MODE))
+    STREAM_JSON = parse_bool(read_optional_field(fields, "STREAM_JSON", STREAM_JSON))
+    STREAM_MIN_BYTES = int(float(read_optional_field(fields, "STREAM_MIN_KB", STREAM_MIN_BYTES / 1024)) * 1024)
+    ARCHIVE_MODE = parse_bool(read_optional_field(fields, "ARCHIVE_MODE", ARCHIVE_MODE))
+    RUN_DEADLINE_SECONDS = float(read_optional_field(fields, "RUN_DEADLINE_SECONDS", RUN_DEADLINE_SECONDS))
+    WARMUP_MINUTES = int(read_optional_field(fields, "WARMUP_MINUTES", WARMUP_MINUTES))
+    ADAPTIVE_POLLING = parse_bool(read_optional_field(fields, "ADAPTIVE_POLLING", ADAPTIVE_POLLING))
+    HOURLY_SKIP_UNCHANGED = parse_bool(read_optional_field(fields, "HOURLY_SKIP_UNCHANGED", HOURLY_SKIP_UNCHANGED))
+    HOURLY_ATTACHMENT = str(read_optional_field(fields, "HOURLY_ATTACHMENT", HOURLY_ATTACHMENT)).strip().lower()
+    cadence.configure(
+        poll_minutes=read_optional_field(fields, "POLL_MINUTES", cadence.POLL_MINUTES),
+        max_interval_minutes=read_optional_field(fields, "POLL_MAX_INTERVAL_MINUTES", cadence.MAX_INTERVAL_MINUTES),
+        budget_per_hour=read_optional_field(fields, "POLL_BUDGET_PER_HOUR", cadence.BUDGET_PER_HOUR),
+    )
+    status_store.configure(
+        retention_days=read_optional_field(fields, "HISTORY_RETENTION_DAYS", status_store.RETENTION_DAYS),
+    )
+    telemetry_archive.configure(
+        max_segment_mb=read_optional_field(fields, "ARCHIVE_MAX_SEGMENT_MB", telemetry_archive.MAX_SEGMENT_BYTES / (1024 * 1024)),
+        retention_days=read_optional_field(fields, "ARCHIVE_RETENTION_DAYS", telemetry_archive.RETENTION_DAYS),
+    )
+    http_client.configure(
+        pool_size=read_optional_field(fields, "HTTP_POOL_SIZE", http_client.POOL_SIZE),
+        timeout=read_optional_field(fields, "HTTP_TIMEOUT", http_client.TIMEOUT),
+    )
+    sweep_cache.configure(
+        ttl_minutes=read_optional_field(fields, "CACHE_TTL_MINUTES", sweep_cache.TTL_SECONDS / 60),
+    )
+    retry.configure(
+        max_retries=read_optional_field(fields, "HTTP_RETRIES", retry.MAX_RETRIES),
+        base_delay=read_optional_field(fields, "RETRY_BASE_SECONDS", retry.BASE_DELAY),
+        max_delay=read_optional_field(fields, "RETRY_MAX_SECONDS", retry.MAX_DELAY),
+        breaker_failures=read_optional_field(fields, "BREAKER_FAILURES", retry.BREAKER_FAILURES),
+        breaker_open_seconds=read_optional_field(fields, "BREAKER_OPEN_SECONDS", retry.BREAKER_OPEN_SECONDS),
+    )
+    metrics.configure(
+        address=read_optional_field(fields, "METRICS_ADDRESS", metrics.ADDRESS),
+        port=read_optional_field(fields, "METRICS_PORT", metrics.PORT),
+        file_seconds=read_optional_field(fields, "METRICS_FILE_SECONDS", metrics.FILE_SECONDS),
+    )
+    run_log.configure(
+        level=read_optional_field(fields, "LOG_LEVEL", "INFO"),
+        file=read_optional_field(fields, "LOG_FILE", run_log.FILE),
+        max_bytes=float(read_optional_field(fields, "LOG_MAX_MB", run_log.MAX_BYTES / (1024 * 1024))) * 1024 * 1024,
+        backups=read_optional_field(fields, "LOG_BACKUPS", run_log.BACKUPS),
+        ring_size=read_optional_field(fields, "LOG_RING_SIZE", run_log.RING_SIZE),
+    )
+    token_cache.configure(
+        lifetime=float(read_optional_field(fields, "TOKEN_LIFETIME_HOURS", token_cache.LIFETIME / 3600)) * 3600,
+        refresh_margin=float(read_optional_field(fields, "TOKEN_REFRESH_MINUTES", token_cache.REFRESH_MARGIN / 60)) * 60,
+    )
+
+# Look up an optional "NAME | value" row of a config sheet, returns default if the row is missing or empty.
+def read_optional_field(fields, field, default):
+    return fields.get(field, default)
+
+# Excel cells may hold TRUE/FALSE, 1/0 or text such as "yes".
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "yes", "y", "1", "on")
+    return bool(value)
+
 # This function configures the outgoing email specification such as the recipients.
 def configure_email_fields(PLATFORM_FILE_NAME):
-    def parse_recipients_field(recipients):
-        lst = recipients.split(',')
-        for i in range(len(lst)):
-            lst[i] = lst[i].strip()
-        return lst
-        
-    global SMTP_SERVER, SENDER_EMAIL, RECIPIENTS_IOT_TEAM, RECIPIENTS_EVERYONE, EMAIL_API_KEY, PORT
-    df = pd.read_excel(io=PLATFORM_FILE_NAME, sheet_name=EMAIL_SHEET)
+    global SMTP_SERVER, SENDER_EMAIL, RECIPIENTS_IOT_TEAM, RECIPIENTS_EVERYONE, EMAIL_API_KEY, PORT, REPORT_FORMATS_IOT_TEAM, REPORT_FORMATS_EVERYONE
+    config = config_loader.load_config(PLATFORM_FILE_NAME)
 
-    SMTP_SERVER = df.iloc[0][1]
-    PORT = df.iloc[1][1]
-    SENDER_EMAIL = df.iloc[2][1]
-    EMAIL_API_KEY = df.iloc[3][1]
+    SMTP_SERVER = config.smtp_server
+    PORT = config.port
+    SENDER_EMAIL = config.sender_email
+    EMAIL_API_KEY = config.email_api_key
     # Configure recipients for hourly or daily.
-    RECIPIENTS_IOT_TEAM = parse_recipients_field(df.iloc[4][1])
-    RECIPIENTS_EVERYONE = parse_recipients_field(df.iloc[5][1])
+    RECIPIENTS_IOT_TEAM = list(config.recipients_iot_team)
+    RECIPIENTS_EVERYONE = list(config.recipients_everyone)
+    # Report formats per recipient list, a comma separated list of docx, json, csv and html
+    fields = config.email_fields
+    REPORT_FORMATS_IOT_TEAM = report_formats.parse_formats(read_optional_field(fields, "REPORT_FORMATS_IOT_TEAM", "docx"))
+    REPORT_FORMATS_EVERYONE = report_formats.parse_formats(read_optional_field(fields, "REPORT_FORMATS_EVERYONE", "docx"))
+    mailer.configure(
+        SMTP_SERVER, PORT, SENDER_EMAIL, EMAIL_API_KEY,
+        use_ssl=parse_bool(read_optional_field(fields, "SMTP_SSL", mailer.USE_SSL)),
+        retry_base_seconds=read_optional_field(fields, "OUTBOX_RETRY_BASE_SECONDS", mailer.RETRY_BASE_SECONDS),
+        retry_max_seconds=read_optional_field(fields, "OUTBOX_RETRY_MAX_SECONDS", mailer.RETRY_MAX_SECONDS),
+        expire_hours=read_optional_field(fields, "OUTBOX_EXPIRE_HOURS", mailer.EXPIRE_HOURS),
+        timeout=read_optional_field(fields, "SMTP_TIMEOUT_SECONDS", mailer.TIMEOUT),
+    )
     
 ### ---------- Logic V1 ----------###
 # ONLINE    -- Dataplicity online + platform showing logs in the last WITHIN_HOURS
@@ -145,17 +260,67 @@ def configure_email_fields(PLATFORM_FILE_NAME):
 ## Dataplicity offline + not showing logs from last WITHIN_DAYS
 ### Display Dataplicity OFFLINE, VFlowTechIoT OFFLINE
 
+#======================= Authentication =======================#
+# Tokens are kept by token_cache across runs, these sign-in functions are only called when
+# there is no cached token, the cached token is about to expire, or the platform rejected it (HTTP 401).
+def dataplicity_sign_in():
+    url = DATAPLICITY_BASE_URL + "/auth/"
+    rq = http_client.post(url, data=DATAPLICITY_LOGIN)
+    return rq.json()["token"]
+
+# VFlowTechIoT requires two steps, account sign-in then organisation sign-in. Only the organisation token is cached.
+def vft_sign_in():
+    login_url = VFT_BASE_URL + "/api/sign-in"
+    login_rq = http_client.post(login_url, data=ACCOUNT_LOGIN)
+    login_token = login_rq.json()["access_token"]
+
+    url = VFT_BASE_URL + "/api/orgs/3/sign-in"
+    org_headers = {"Auth-Token": f"{login_token}"}
+    rq = http_client.post(url, headers=org_headers)
+    return rq.json()["access_token"]
+
+def mads_sign_in():
+    url = MADS_BASE_URL + "/api/sign-in"
+    rq = http_client.post(url, data=ACCOUNT_LOGIN)
+    return rq.json()["access_token"]
+
+# Loads the run's tokens before the first request, signing in where needed, so sign-in shows as its own phase.
+# A failed sign-in is only printed, the status checks sign in again and report the platform as unreachable.
+def sign_in_platforms(mads):
+    logins = [("dataplicity", DATAPLICITY_LOGIN, dataplicity_sign_in)]
+    if mads:
+        logins.append(("mads", ACCOUNT_LOGIN, mads_sign_in))
+    else:
+        logins.append(("vft", ACCOUNT_LOGIN, vft_sign_in))
+    for platform, login, sign_in in logins:
+        try:
+            token_cache.get_token(get_token_key(platform, login), sign_in)
+        except Exception as ex:
+            log.warning("Sign-in to " + platform + " failed: " + str(ex))
+
+# Tokens are cached per platform and account, changing the login in the config workbook forces a new sign-in.
+def get_token_key(platform, login):
+    return platform + ":" + str(login["email"])
+
+# GET with a cached token. If the token is rejected, sign in again and retry once.
+# A new token that is rejected as well is not kept, the next request signs in again instead of reusing it until it expires.
+def authorized_get(url, token_key, sign_in, auth_scheme, **kwargs):
+    token = token_cache.get_token(token_key, sign_in)
+    response = http_client.get(url, headers={"Authorization": f"{auth_scheme} {token}"}, **kwargs)
+    if response.status_code == 401:
+        response.close()
+        token = token_cache.refresh(token_key, sign_in, token)
+        response = http_client.get(url, headers={"Authorization": f"{auth_scheme} {token}"}, **kwargs)
+        if response.status_code == 401:
+            log.warning("Token for " + token_key.split(":")[0] + " was rejected right after signing in.")
+            token_cache.invalidate(token_key, token)
+    return response
+
 # This function will only read dataplicity function
 def run_dataplicity_status():
-    # get auth token
-    url = "https://apps.dataplicity.com/auth/"
-    rq = requests.post(url, data=DATAPLICITY_LOGIN)
-    token = rq.json()["token"]
-
-    endpoint = "https://apps.dataplicity.com/devices/"
-    headers = {"Authorization": f"Token {token}"}
+    endpoint = DATAPLICITY_BASE_URL + "/devices/"
     try:
-        response = requests.get(endpoint, headers=headers)
+        response = authorized_get(endpoint, get_token_key("dataplicity", DATAPLICITY_LOGIN), dataplicity_sign_in, "Token")
         json_dump = response.json()
         statuses = {}
         for unit in json_dump:
@@ -164,8 +329,8 @@ def run_dataplicity_status():
             if unit["online"]:
                 statuses[unit["name"]] = "online"
         return statuses
-    except Exception as ex:
-        print(ex)
+    except Exception:
+        log.exception("Could not read the device statuses from Dataplicity.")
 
 # This function is no longer up to date as of June 2023
 def run_mad_status(dataplicity_status, units):
@@ -173,12 +338,8 @@ def run_mad_status(dataplicity_status, units):
     
     # key: name, value: (online/offline, loc, remarks)
     status = {}
-    count = 1
-
-    # get auth token
-    url = "https://datakrewtech.com/api/sign-in"
-    rq = requests.post(url, data=ACCOUNT_LOGIN)
-    token = rq.json()["access_token"]
+    LAST_DATAPOINT_LATENCY.clear()
+    token_key = get_token_key("mads", ACCOUNT_LOGIN)
 
     curr_time = get_current_time()
     start_time = get_partial_from(curr_time, WITHIN_DAYS) # consider logs from WITHIN_DAYS ago
@@ -190,22 +351,27 @@ def run_mad_status(dataplicity_status, units):
         remarks = values[2] # to display if offline or partial
 
         # Likely a mismatch in unit's name since all units on platform must be linked to dataplicity
+        context = run_log.fields(unit=unit_name, gateway=key)
         if unit_name not in dataplicity_status:
-            print("No matching name on dataplicity for " + unit_name)
+            log.warning("No matching name on dataplicity.", extra=context)
             continue
         
         # Unit is offline on dataplicity
         if dataplicity_status[unit_name] == "offline":
-            print("Dataplicity indicates " + unit_name + " is offline")
+            log.debug("Dataplicity indicates the unit is offline.", extra=context)
             status[unit_name] = ("offline", loc, remarks)
             continue
+
+        if get_time_left() <= 0:
+            log.debug("Run deadline reached, unit not checked.", extra=context)
+            status[unit_name] = ("error", loc, DEADLINE_EXCEEDED)
+            continue
         
         endpoint = (
-            "https://datakrewtech.com/api/iot_mgmt/orgs/3/projects/70/gateways/"
+            MADS_BASE_URL + "/api/iot_mgmt/orgs/3/projects/70/gateways/"
             + str(key)
             + "/data_dump_index"
         )
-        headers = {"Authorization": f"Bearer {token}"}
         params = {
             "page_size": LOGS_DISPLAY_PAGE_SIZE,
             "page_number": LOGS_DISPLAY_PAGE_NUMBER,
@@ -213,91 +379,91 @@ def run_mad_status(dataplicity_status, units):
             "from_date": start_time,
         }    
 
-        response = requests.get(endpoint, headers=headers, params=params)
+        # HTTP 500 (when a gateway is not called for a period of time) is retried by http_client,
+        # a rejected token is renewed by authorized_get
+        try:
+            response = authorized_get(endpoint, token_key, mads_sign_in, "Bearer", params=params, stream=is_streaming())
+        except http_client.RequestException as ex:
+            log.warning("Error in fetching data for MADs: " + str(ex), extra=context)
+            status[unit_name] = ("error", loc, FAILED_RETRIEVAL)
+            continue
+        except Exception:                                   # e.g. a sign-in answer without a token, keep the run going
+            log.exception("Unexpected error in fetching data for MADs.", extra=context)
+            status[unit_name] = ("error", loc, UNEXPECTED_ERROR)
+            continue
 
         if response.status_code != 200:
-            print("Error in fetching " + unit_name + " data for MADs, HTTP status code: ", response.status_code)
+            response.close()
+            log.warning("Error in fetching data for MADs, HTTP status code " + str(response.status_code) + ".", extra=context)
             status[unit_name] = ("error", loc, FAILED_RETRIEVAL)
-            if response.status_code == 500:
-                response = retry_ping(response, unit_name, endpoint, headers, params, 0)
             continue # do not process further
 
         try:
-            json_dump = response.json()
-            json_string = json.dumps(json_dump, indent=4)
-            filename = "data_dump/data_dump_" + str(count) + ".json"
-            with open(filename, "w") as outfile:
-                outfile.write(json_string)
+            if is_streaming():
+                json_dump = read_streamed_data_dump(response, need_total=True)     # num_entries below
+            else:
+                json_dump = response.json()
+                if ARCHIVE_MODE:
+                    telemetry_archive.append(key, unit_name, curr_time, json_dump)
+            data_logs = json_dump["data_dumps"]
+            if len(data_logs) > 0:
+                timestamp_epoch = data_logs[0]["data"]["timestamp"]
+                num_entries = json_dump["total_entries"]
                 
         except json.JSONDecodeError:
-            print(
-                "JSONDecodeError for "
-                + unit_name
-                + ", check if unit_id is entered correctly in config.json"
-            )
-
-        count += 1
+            log.warning("JSONDecodeError, check if unit_id is entered correctly in config.json", extra=context)
+            status[unit_name] = ("error", loc, FAILED_RETRIEVAL)
+            continue
+        except (KeyError, IndexError, TypeError) as ex:
+            log.warning("Unexpected data_dump_index response: " + type(ex).__name__ + " " + str(ex), extra=context)
+            status[unit_name] = ("error", loc, FAILED_RETRIEVAL)
+            continue
+        except Exception:
+            log.exception("Unexpected error in reading data for MADs.", extra=context)
+            status[unit_name] = ("error", loc, UNEXPECTED_ERROR)
+            continue
 
         start_track = get_online_from(curr_time, WITHIN_HOURS) # must show data WITHIN_HOURS to be considered 'online'
-        data_logs = json_dump["data_dumps"]
-        
         
         if len(data_logs) > 0:
-            timestamp_epoch = data_logs[0]["data"]["timestamp"]
+            LAST_DATAPOINT_LATENCY[unit_name] = curr_time - int(timestamp_epoch * 1000)
 
             if timestamp_epoch * 1000 >= start_track:
                 status[unit_name] = ("online", loc, "")
-                print(unit_name + ": " + "online")
+                log.debug("Online on MADs.", extra=context)
             else:
                 status[unit_name] = ("partial", loc, remarks)
-                print(unit_name + ": " + "partial data in the last " + str(WITHIN_DAYS) + " days")
-
-            num_entries = json_dump["total_entries"]
+                log.debug("Partial data in the last " + str(WITHIN_DAYS) + " days.", extra=context)
             
         else: # no logs found
             remarks = "No logs data in the last " + str(WITHIN_DAYS) + " days" # overwrite
             status[unit_name] = ("offline", loc, remarks)
-            print(unit_name + " found but no logs data in the last " + str(WITHIN_DAYS) + " days")
+            log.debug("Found but no logs data in the last " + str(WITHIN_DAYS) + " days.", extra=context)
 
+    telemetry_archive.close()
     return status
 
-# Error occurs (HTML Code: 500), when a gateway is not called for a period of time.
-def retry_ping(response, unit_name, endpoint, headers, params, count):
-    if count < 5:
-        print("Error probably due to delay in data loading, sleep for 5 seconds.")
-        time.sleep(5)
-        response = requests.get(endpoint, headers=headers, params=params)
-        if response.status_code == 500:
-            retry_ping(response, unit_name, endpoint, headers, params, count+1)
-        else:
-            if response.status_code != 200:
-                print("Error in fetching " + unit_name + " data, HTTP status code: ", response.status_code)
-            return response
-    else:
-        print("Error in fetching " + unit_name + " data, HTTP status code: ", response.status_code)
-        return response
-
-def run_vft_status(dataplicity_status, units):
+# adaptive: only query the units cadence.plan finds due, the others are reported from their last result.
+def run_vft_status(dataplicity_status, units, adaptive=False):
     os.makedirs("data_dump", exist_ok=True)
 
     # key: name, value: (Dataplicity online/offline, VFT online/offline, loc, remarks)
     status = {}
-    count = 1
-
-    # get auth token
-    login_url = "https://backend.vflowtechiot.com/api/sign-in"
-    login_rq = requests.post(login_url, data=ACCOUNT_LOGIN)
-    login_token = login_rq.json()["access_token"]
-
-    url = "https://backend.vflowtechiot.com/api/orgs/3/sign-in"
-    org_headers = {"Auth-Token": f"{login_token}"}
-    rq = requests.post(url, headers=org_headers)
-    token = rq.json()["access_token"]
-    
+    LAST_DATAPOINT_LATENCY.clear()
+    UNIT_FETCH_STATS.clear()
+    CACHED_UNITS.clear()
 
     curr_time = get_current_time()
-    start_time = get_partial_from(curr_time, WITHIN_DAYS) # consider logs from WITHIN_DAYS days ago
+    reset_transfer_stats()
+    due = cadence.plan(units, curr_time) if adaptive else None
 
+    # Gateways are queried in parallel, bounded by MAX_WORKERS.
+    # Futures are kept in unit order so the returned status dict is ordered the same as the units sheet.
+    # Units still running at the run deadline are reported as error, their threads are left to finish in the background
+    # and drop their results, see end_sweep.
+    futures = []
+    generation = SWEEP_GENERATION
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
     for key, values in units.items():
         # get details
         unit_name = values[0]
@@ -306,7 +472,7 @@ def run_vft_status(dataplicity_status, units):
 
         # Likely a mismatch in unit's name since all units on platform must be linked to dataplicity
         if unit_name not in dataplicity_status:
-            print("No matching name on dataplicity for " + unit_name)
+            log.warning("No matching name on dataplicity.", extra=run_log.fields(unit=unit_name, gateway=key))
             continue
         
         # Logic V1, this code will skip VFT device check if dataplicity is offline.
@@ -315,113 +481,362 @@ def run_vft_status(dataplicity_status, units):
         #     print("Dataplicity indicates " + unit_name + " is offline")
         #     status[unit_name] = ("offline", loc, remarks)
         #     continue
-        
-        endpoint = (
-            "https://backend.vflowtechiot.com/api/iot_mgmt/orgs/3/projects/70/gateways/"
-            + str(key)
-            + "/data_dump_index"
+
+        within_hours, within_days = get_unit_thresholds(key)
+        start_time = get_partial_from(curr_time, within_days) # consider logs from within_days days ago
+        future = executor.submit(
+            fetch_vft_unit, key, unit_name, dataplicity_status[unit_name],
+            curr_time, start_time, within_hours, get_max_cache_age(key, due), generation
         )
-        headers = {"Authorization": f"Bearer {token}"}
-        params = {
-            "page_size": LOGS_DISPLAY_PAGE_SIZE,
-            "page_number": LOGS_DISPLAY_PAGE_NUMBER,
-            "to_date": curr_time,
-            "from_date": start_time,
-        }
+        futures.append((key, unit_name, loc, remarks, within_hours, within_days, future))
 
-        response = requests.get(endpoint, headers=headers, params=params)
+    done, _ = wait([future for *_, future in futures], timeout=None if RUN_DEADLINE is None else max(get_time_left(), 0))
+    executor.shutdown(wait=False, cancel_futures=True)
+    end_sweep()
+    if due is not None:                                     # Due units that were started queried their gateway
+        cadence.record_polls(sum(1 for key, *_, future in futures if key in due and not future.cancelled()), curr_time)
+    mark_phase("gateway sweep")
 
-        if response.status_code != 200:
-            if dataplicity_status[unit_name] == "offline":
-                print(unit_name + " is offline on Dataplicity.")
-            else:
-                print(unit_name + " is online on Dataplicity.")
-            print("Error in fetching " + unit_name + " data for VFT, HTTP status code: ", response.status_code)
+    # Columns of the units that were fetched, classified together below
+    fetched = {"key": [], "unit": [], "loc": [], "last_timestamp": [], "fetched_at": [], "dataplicity_offline": [], "remarks": [],
+               "within_hours": [], "within_days": [], "note": []}
+    late = 0
+    for key, unit_name, loc, remarks, within_hours, within_days, future in futures:
+        status[unit_name] = None                            # Keep the units sheet order
+        if future not in done or future.cancelled():
+            status[unit_name] = ("error", loc, remarks + "\n" + DEADLINE_EXCEEDED)
+            late += 1
+            continue
+        try:
+            result = future.result()
+        except Exception:                                   # A bug or an unexpected answer fails the unit, not the run
+            log.exception("Unexpected error in fetching data for VFT.", extra=run_log.fields(unit=unit_name, gateway=key))
+            status[unit_name] = ("error", loc, remarks + "\n" + UNEXPECTED_ERROR)
+            continue
+        if result is None:
             status[unit_name] = ("error", loc, remarks + "\n" + FAILED_RETRIEVAL)
-            continue # do not process further
+            continue
+        fetched_at, last_timestamp, note = result
+        fetched["key"].append(key)
+        fetched["unit"].append(unit_name)
+        fetched["loc"].append(loc)
+        fetched["last_timestamp"].append(float("nan") if last_timestamp is None else last_timestamp)
+        fetched["fetched_at"].append(fetched_at)
+        fetched["dataplicity_offline"].append(dataplicity_status[unit_name] == "offline")
+        fetched["remarks"].append(remarks)
+        fetched["within_hours"].append(within_hours)
+        fetched["within_days"].append(within_days)
+        fetched["note"].append(note)
+
+    results = classifier.classify_units(
+        fetched["last_timestamp"], fetched["fetched_at"], fetched["dataplicity_offline"], fetched["remarks"],
+        fetched["within_hours"], fetched["within_days"],
+    )
+    for i, (platform_state, remarks, latency) in enumerate(results):
+        unit_name = fetched["unit"][i]
+        log_vft_unit(fetched["key"][i], unit_name, fetched["dataplicity_offline"][i], platform_state, fetched["within_days"][i])
+        if latency is not None:
+            LAST_DATAPOINT_LATENCY[unit_name] = latency
+        if fetched["note"][i]:
+            remarks = remarks + "\n" + fetched["note"][i]
+        status[unit_name] = (platform_state, fetched["loc"][i], remarks)
 
+    if late:
+        log.warning(str(late) + " of " + str(len(futures)) + " units did not answer before the run deadline.")
+    if CACHED_UNITS:
+        log.info("Served " + str(len(CACHED_UNITS)) + " of " + str(len(futures)) + " units from cache.")
+    telemetry_archive.close()
+    report_transfer_stats(len(futures) - len(CACHED_UNITS))
+    mark_phase("classification")
+    return status
+
+# Query a single gateway on VFlowTechIoT, or take its result from sweep_cache.
+# Runs inside the run_vft_status thread pool. Returns (fetched_at in epoch ms, timestamp of the newest record or None
+# when there are no logs, note for the remarks), or None if the gateway could not be read.
+# start_time, within_hours: the unit's thresholds, see get_unit_thresholds
+# max_cache_age: seconds, reuse a cached result younger than this instead of querying (sweep_cache.TTL_SECONDS by default)
+# generation: the sweep's SWEEP_GENERATION, nothing is written once the sweep has ended
+def fetch_vft_unit(key, unit_name, dataplicity_state, curr_time, start_time, within_hours, max_cache_age=None, generation=None):
+    SWEEP_LOCAL.generation = generation
+    cached = sweep_cache.get(key, curr_time, max_cache_age)
+    if cached is not None:
+        fetched_at, json_dump = cached
+        cache_age = int((curr_time - fetched_at) / 60000)
+        with SWEEP_LOCK:
+            if not is_current_sweep():
+                return None
+            CACHED_UNITS[unit_name] = cache_age
+        cache_note = "Served from cache, " + str(cache_age) + " min old."
+        log.debug(cache_note, extra=run_log.fields(unit=unit_name, gateway=key))
+        return (fetched_at, get_last_timestamp(json_dump), cache_note)
+
+    endpoint = get_vft_endpoint(key)
+    json_dump = None
+    fetch_start = time.monotonic()
+    retries = retry.get_retry_count()
+    try:
+        if PROBE_MODE:
+            response, json_dump = probe_vft_gateway(endpoint, curr_time, start_time, within_hours)
+        else:
+            params = {
+                "page_size": LOGS_DISPLAY_PAGE_SIZE,
+                "page_number": LOGS_DISPLAY_PAGE_NUMBER,
+                "to_date": curr_time,
+                "from_date": start_time,
+            }
+            response = get_vft_data_dump(endpoint, params, stream=is_streaming())
+    except http_client.RequestException as ex:
+        # Connection failed after retries, or the circuit for the backend is open
+        log.warning("Error in fetching data for VFT: " + str(ex), extra=run_log.fields(unit=unit_name, gateway=key))
+        return None
+    finally:
+        with SWEEP_LOCK:
+            if is_current_sweep():
+                UNIT_FETCH_STATS[unit_name] = (time.monotonic() - fetch_start, retry.get_retry_count() - retries)
+
+    if response.status_code != 200:
+        log.warning("Error in fetching data for VFT, HTTP status code " + str(response.status_code) + ".",
+                    extra=run_log.fields(unit=unit_name, gateway=key, dataplicity=dataplicity_state))
+        return None # do not process further
+
+    streamed = json_dump is None and is_streaming() and not PROBE_MODE
+    try:
+        if streamed:
+            json_dump = read_streamed_data_dump(response)
+        elif json_dump is None:
+            json_dump = response.json()
+            
+    except json.JSONDecodeError:
+        log.warning("JSONDecodeError, check if unit_id is entered correctly in config.json", extra=run_log.fields(unit=unit_name, gateway=key))
+        return None
+
+    with SWEEP_LOCK:
+        if not is_current_sweep():
+            return None                                     # Past the run deadline, the unit was reported as error
+        if ARCHIVE_MODE and not streamed:           # A streamed response is not kept whole
+            telemetry_archive.append(key, unit_name, curr_time, json_dump)
+        sweep_cache.put(key, curr_time, json_dump)
+    return (curr_time, get_last_timestamp(json_dump), "")
+
+# max_cache_age of a unit for fetch_vft_unit. With adaptive polling a due unit is always queried and the others are
+# reported from their last result however old, without it CACHE_TTL_MINUTES applies.
+def get_max_cache_age(key, due):
+    if due is None:
+        return None
+    return 0 if key in due else float("inf")
+
+# False in a worker whose sweep has ended. Callers outside a sweep (generation None) are always current.
+def is_current_sweep():
+    generation = getattr(SWEEP_LOCAL, "generation", None)
+    return generation is None or generation == SWEEP_GENERATION
+
+# Called once a sweep stops waiting for its workers, the ones still running drop their results from now on
+def end_sweep():
+    global SWEEP_GENERATION
+    with SWEEP_LOCK:
+        SWEEP_GENERATION += 1
+
+# Epoch seconds of the newest record in a data_dump_index result, None if there are no logs
+def get_last_timestamp(json_dump):
+    data_logs = json_dump["data_dumps"]
+    if len(data_logs) > 0:
+        return data_logs[0]["data"]["timestamp"]
+    return None
+
+# Logic V2 is applied by classifier.classify_units, this logs the outcome of one unit like the per-unit checks did.
+# One debug record per unit, shown with LOG_LEVEL DEBUG and kept in the ring buffer otherwise.
+def log_vft_unit(key, unit_name, dataplicity_offline, platform_state, within_days):
+    if platform_state == "online":
+        message = "Online on VFlowTechIoT."
+    elif platform_state == "partial":
+        message = "Partial data in the last " + str(within_days) + " days."
+    else:
+        message = "Found but no logs data in the last " + str(within_days) + " days."
+    log.debug(message, extra=run_log.fields(unit=unit_name, gateway=key, dataplicity="offline" if dataplicity_offline else "online"))
+
+# (WITHIN_HOURS, WITHIN_DAYS) of a unit, from the optional WITHIN_HOURS / WITHIN_DAYS columns of its units sheet
+def get_unit_thresholds(key):
+    within_hours, within_days = UNIT_THRESHOLDS.get(key, (None, None))
+    return (WITHIN_HOURS if within_hours is None else within_hours, WITHIN_DAYS if within_days is None else within_days)
+
+# Seconds left before the run deadline, unlimited outside generate_report
+def get_time_left():
+    if RUN_DEADLINE is None:
+        return float("inf")
+    return RUN_DEADLINE - time.monotonic()
+
+def get_vft_endpoint(key):
+    return (
+        VFT_BASE_URL + "/api/iot_mgmt/orgs/3/projects/70/gateways/"
+        + str(key)
+        + "/data_dump_index"
+    )
+
+# The archive needs the whole response, so streaming is only used when archive mode is off.
+def is_streaming():
+    return STREAM_JSON and not ARCHIVE_MODE
+
+# With stream=True the body of a successful response is left unread, see read_streamed_data_dump.
+def get_vft_data_dump(endpoint, params, stream=False):
+    response = authorized_get(endpoint, get_token_key("vft", ACCOUNT_LOGIN), vft_sign_in, "Bearer", params=params, stream=stream)
+    if not stream or response.status_code != 200:
+        record_transfer(len(response.content))
+    return response
+
+# Decode a streamed data_dump_index response with json_stream, which keeps only the newest record's timestamp
+# (and total_entries with need_total) and stops reading once they are known. Stopping early closes the connection,
+# so a response whose Content-Length is below STREAM_MIN_BYTES is decoded whole instead and its connection goes
+# back to the pool. Raises json.JSONDecodeError like response.json().
+def read_streamed_data_dump(response, need_total=False):
+    length = response.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) < STREAM_MIN_BYTES:
+        json_dump = response.json()
+        record_transfer(len(response.content))
+        return json_dump
+    received = [0]
+    def chunks():
+        for chunk in response.iter_content(chunk_size=json_stream.CHUNK_SIZE):
+            received[0] += len(chunk)
+            yield chunk
+    try:
+        return json_stream.read_data_dump_summary(chunks(), need_total=need_total)
+    finally:
+        response.close()                                    # Drop the rest of the body
+        record_transfer(received[0])
+
+# Probe mode: only the newest record is needed to classify a unit, so ask for one record.
+# Look in the unit's within_hours window first, and only widen to its start_time (within_days) if nothing was found.
+# Returns (last response, decoded json or None if it could not be decoded).
+def probe_vft_gateway(endpoint, curr_time, start_time, within_hours):
+    json_dump = None
+    for from_date in (max(get_online_from(curr_time, within_hours), start_time), start_time):
+        params = {
+            "page_size": 1,
+            "page_number": 1,
+            "to_date": curr_time,
+            "from_date": from_date,
+        }
+        response = get_vft_data_dump(endpoint, params)
+        if response.status_code != 200:
+            return response, None
         try:
             json_dump = response.json()
-            json_string = json.dumps(json_dump, indent=4)
-            filename = "data_dump/data_dump_" + str(count) + ".json"
-            with open(filename, "w") as outfile:
-                outfile.write(json_string)
-                
         except json.JSONDecodeError:
-            print(
-                "JSONDecodeError for "
-                + unit_name
-                + ", check if unit_id is entered correctly in config.json"
-            )
-
-        count += 1
-       
-        start_track = get_online_from(curr_time, WITHIN_HOURS) # must show data WITHIN_HOURS to be considered 'online'
-        data_logs = json_dump["data_dumps"]
-    
-        if len(data_logs) > 0:
-            timestamp_epoch = data_logs[0]["data"]["timestamp"]
+            return response, None                           # Reported by the caller
+        if len(json_dump["data_dumps"]) > 0:
+            break
+    return response, json_dump
 
-            # platform showing logs in the last WITHIN_HOURS
-            if timestamp_epoch * 1000 >= start_track:
-                # Dataplicity is offline
-                if dataplicity_status[unit_name] == "offline":
-                    print(unit_name + " is offline on Dataplicity.")
-                    remarks = remarks + "\n" + "Device is disconnected from dataplicity."
-                else:
-                    print(unit_name + " is online on Dataplicity.")
-                status[unit_name] = ("online", loc, remarks)
-                print(unit_name + " is online on VFlowTechIoT.")
-            else:
-                # Dataplicity is offline
-                if dataplicity_status[unit_name] == "offline":
-                    print(unit_name + " is offline on Dataplicity.")
-                    remarks = remarks + "\n" + "Device is disconnected from dataplicity and experiencing data lag?"
-                else:
-                    print(unit_name + " is online on Dataplicity.")
-                    remarks = remarks + "\n" + "Device is experiencing data lag."
-                status[unit_name] = ("partial", loc, remarks)
-                print(unit_name + ": " + "partial data in the last " + str(WITHIN_DAYS) + " days")
+#======================= Transfer Stats =======================#
+# Bytes received from data_dump_index per run, saved per mode so probe mode can be compared against full-page mode.
+TRANSFER_STATS_FILE = "data_dump/transfer_stats.json"
+TRANSFER_STATS = {"requests": 0, "bytes": 0}
 
-            num_entries = json_dump["total_entries"]
-            
-        else: # no logs found
-            if dataplicity_status[unit_name] == "offline":
-                print(unit_name + " is offline on Dataplicity.")
-            else:
-                print(unit_name + " is online on Dataplicity.")
-                remarks = "No logs data in the last " + str(WITHIN_DAYS) + " days. IoT disconnection." # overwrite
-            status[unit_name] = ("offline", loc, remarks)
-            print(unit_name + " found but no logs data in the last " + str(WITHIN_DAYS) + " days")
-    return status
-        
+def reset_transfer_stats():
+    with SWEEP_LOCK:
+        TRANSFER_STATS["requests"] = 0
+        TRANSFER_STATS["bytes"] = 0
 
-### Utils
-def _set_cell_background(cell, fill, color = None, val = None):
-    """
-    @fill: Specifies the color to be used for the background
-    @color: Specifies the color to be used for any foreground
-    pattern specified with the val attribute
-    @val: Specifies the pattern to be used to lay the pattern
-    color over the background color.
-    """
-    cell_properties = cell._element.tcPr
-    if cell_properties.xpath("w:shd"): # exists existing shading
-        cell_shading = cell_properties.xpath("w:shd")[0]
-    else: # add new w:shd element
-        cell_shading = OxmlElement("w:shd")
+# Requests of workers whose sweep has ended are not counted
+def record_transfer(num_bytes):
+    with SWEEP_LOCK:
+        if not is_current_sweep():
+            return
+        TRANSFER_STATS["requests"] += 1
+        TRANSFER_STATS["bytes"] += num_bytes
 
-    if fill:
-        cell_shading.set(qn("w:fill"), fill)
-    if color:
-        pass #TODO
-    if val:
-        pass #TODO
+def report_transfer_stats(num_gateways):
+    mode = "probe" if PROBE_MODE else "full-page"
+    other_mode = "full-page" if PROBE_MODE else "probe"
+    log.info(
+        "Transferred " + str(TRANSFER_STATS["bytes"]) + " bytes in " + str(TRANSFER_STATS["requests"])
+        + " requests for " + str(num_gateways) + " gateways (" + mode + " mode)."
+    )
+    history = {}
+    if exists(TRANSFER_STATS_FILE):
+        try:
+            with open(TRANSFER_STATS_FILE) as infile:
+                history = json.load(infile)
+        except ValueError:
+            history = {}
+    history[mode] = {"gateways": num_gateways, "requests": TRANSFER_STATS["requests"], "bytes": TRANSFER_STATS["bytes"]}
+    # Compare per gateway, the two modes may have run over different unit lists
+    if other_mode in history and history[other_mode]["gateways"] and num_gateways:
+        per_gateway = TRANSFER_STATS["bytes"] / num_gateways
+        other_per_gateway = history[other_mode]["bytes"] / history[other_mode]["gateways"]
+        log.info(
+            "Average per gateway: " + str(int(per_gateway)) + " bytes (" + mode + ") vs "
+            + str(int(other_per_gateway)) + " bytes (" + other_mode + ", last run)."
+        )
+    with open(TRANSFER_STATS_FILE, "w") as outfile:
+        json.dump(history, outfile, indent=4)
 
-    #extend cell props with shading
-    cell_properties.append(cell_shading)
+#======================= Warm-up =======================#
+# The platform returns HTTP 500 for gateways that have not been queried for a while, so the 13:00 and 14:00 reports
+# would spend their time in cold-start retries. WARMUP_MINUTES before each of them every gateway of the daily units
+# sheet is asked for a single record (with retries), so the report run finds them warm.
+# key: unit name, value: seconds the unit's warm-up request took, including retries
+WARMUP_STATS = {}
+
+def warm_up_gateways(formatted_time):
+    units = configure_vft(isHourly=False)
+    WARMUP_STATS.clear()
+    curr_time = get_current_time()
+    warmup_start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    generation = SWEEP_GENERATION
+    futures = [(values[0], executor.submit(warm_up_gateway, key, curr_time, generation)) for key, values in units.items()]
+    done, _ = wait([future for _, future in futures], timeout=WARMUP_MINUTES * 60)    # Do not delay the report itself
+    executor.shutdown(wait=False, cancel_futures=True)
+    end_sweep()                                             # Late warm-ups must not count towards the report's transfer
+
+    cold = 0
+    for unit_name, future in futures:
+        if future not in done or future.cancelled():
+            log.debug("Warm-up did not finish in time.", extra=run_log.fields(unit=unit_name))
+            continue
+        try:
+            seconds, retries = future.result()
+        except http_client.RequestException as ex:
+            log.warning("Warm-up failed: " + str(ex), extra=run_log.fields(unit=unit_name))
+            continue
+        WARMUP_STATS[unit_name] = seconds
+        if retries:
+            cold += 1
+    log.info(
+        "Warmed up " + str(len(WARMUP_STATS)) + " of " + str(len(futures)) + " gateways at " + formatted_time
+        + " in " + str(round(time.monotonic() - warmup_start, 1)) + " seconds, " + str(cold) + " were cold."
+    )
 
+# Returns (seconds, retries) of a single record request to the gateway.
+def warm_up_gateway(key, curr_time, generation=None):
+    SWEEP_LOCAL.generation = generation
+    params = {
+        "page_size": 1,
+        "page_number": 1,
+        "to_date": curr_time,
+        "from_date": get_partial_from(curr_time, WITHIN_DAYS),
+    }
+    retries = retry.get_retry_count()
+    start = time.monotonic()
+    response = get_vft_data_dump(get_vft_endpoint(key), params)
+    response.close()
+    return time.monotonic() - start, retry.get_retry_count() - retries
 
+# Compare the report run with the warm-up before it: a hit is a warmed gateway that answered without retries,
+# and the latency saved is what the warm-up request took over the report's request for the same gateways.
+def report_warmup_stats():
+    warmed = [unit for unit in WARMUP_STATS if unit in UNIT_FETCH_STATS]
+    hits = [unit for unit in warmed if UNIT_FETCH_STATS[unit][1] == 0]
+    saved = sum(max(WARMUP_STATS[unit] - UNIT_FETCH_STATS[unit][0], 0) for unit in hits)
+    hit_rate = 100 * len(hits) / len(warmed) if warmed else 0
+    log.info(
+        "Warm-up hit rate: " + str(len(hits)) + " of " + str(len(warmed)) + " gateways (" + str(round(hit_rate))
+        + "%) answered without retries, about " + str(round(saved, 1)) + " seconds of latency saved."
+    )
+    WARMUP_STATS.clear()                                    # Only the run right after the warm-up is compared
+
+### Utils
 def get_current_time():
     return int(time.time() * 1000)
 
@@ -431,10 +846,20 @@ def get_partial_from(curr_time, WITHIN_DAYS):
 def get_online_from(curr_time, WITHIN_HOURS):
     return curr_time - 60 * 60 * WITHIN_HOURS * 1000
 
+# Files in data_dump/ that are kept between runs
+PERSISTENT_DUMP_FILES = [
+    "status.json",                                          # Imported into the status history on first use
+    "status_history.db", "status_history.db-wal", "status_history.db-shm",
+    "token_cache.json",
+    "transfer_stats.json",
+    "outbox",                                               # Emails not delivered yet, see mailer
+    "metrics.prom",                                         # Rewritten by metrics, read by node_exporter
+]
+
 def remove_data_dump():
     folder = 'data_dump/'
     for filename in os.listdir(folder):
-        if filename != "status.json":
+        if filename not in PERSISTENT_DUMP_FILES:
             file_path = os.path.join(folder, filename)
             try:
                 if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -442,7 +867,7 @@ def remove_data_dump():
                 elif os.path.isdir(file_path):
                     shutil.rmtree(file_path)
             except Exception as e:
-                print('Failed to delete %s. Reason: %s' % (file_path, e))
+                log.warning('Failed to delete %s. Reason: %s' % (file_path, e))
 
 def get_greetings(time):
     hour = int(time.split(":")[0])
@@ -460,22 +885,20 @@ def get_greetings(time):
 ### mads: is system running for mads?
 ### isBlockEmail: should system not send email on report completion?
 def generate_report(formatted_time="00:00", mads=False, isBlockEmail=False):
+    global RUN_DEADLINE, PHASE_START
     statusDict = {}
+    history_rows = []                                       # Rows for the status history store
+    http_client.reset_connection_stats()                    # Count connection reuse for this run only
+    retry.reset_stats()
+    RUN_TIMING.clear()
+    PHASE_START = (time.monotonic(), time.process_time())
     # rtn = []
-    document = Document()
-    document.add_heading("Unit Status", 0)
-    table = document.add_table(rows=1, cols=5)
-    heading_cells = table.rows[0].cells
-    heading_cells[0].text = "Unit Name"
     if mads:
-        heading_cells[1].text = "MADs"
+        system = "MADs"
     else:
-        heading_cells[1].text = "VFT"
-    print("Generating report for", heading_cells[1].text)
-    # rtn.append(heading_cells[1].text)
-    heading_cells[2].text = "Dataplicity"
-    heading_cells[3].text = "Location"                     
-    heading_cells[4].text = "Remarks"
+        system = "VFT"
+    log.info("Generating report for " + system)
+    # rtn.append(system)
 
     # because there's a dependency between dataplicity status and platform status
     # if dataplicity offline --> unit is offline regardless of logs shown (Logic V1)
@@ -483,58 +906,95 @@ def generate_report(formatted_time="00:00", mads=False, isBlockEmail=False):
     
     if mads:
         tracked_units = configure_mads()
-        dataplicity_status = run_dataplicity_status()
+    else:
+        isHourly = formatted_time != DAILY_EMAIL_TIME and formatted_time != VALIDATION_EMAIL_TIME
+        tracked_units = configure_vft(isHourly=isHourly)
+    mark_phase("configuration")
+    RUN_DEADLINE = time.monotonic() + RUN_DEADLINE_SECONDS    # Everything after this point shares the run's time budget
+    sign_in_platforms(mads)
+    mark_phase("auth")
+    dataplicity_status = run_dataplicity_status()
+    if dataplicity_status is None:                          # Dataplicity unreachable, still report the platform status
+        dataplicity_status = {values[0]: "error" for values in tracked_units.values()}
+    mark_phase("dataplicity")
+    if mads:
         platform_status = run_mad_status(dataplicity_status, tracked_units)
+        mark_phase("platform")
     else:
-        tracked_units = configure_vft(isHourly=(formatted_time!=DAILY_EMAIL_TIME and formatted_time!=VALIDATION_EMAIL_TIME))
-        dataplicity_status = run_dataplicity_status()
-        platform_status = run_vft_status(dataplicity_status, tracked_units)            
+        platform_status = run_vft_status(dataplicity_status, tracked_units, adaptive=ADAPTIVE_POLLING and isHourly)   # Marks the gateway sweep and classification
+        if WARMUP_STATS:
+            report_warmup_stats()
+    RUN_DEADLINE = None
 
+    report_rows = []                                        # (unit, platform, dataplicity, location, remarks)
+    status_counts = {"online": 0, "partial": 0, "offline": 0, "error": 0}
     for unit, values in platform_status.items():
         unit_status_platform = values[0]
         unit_status_dataplicity = dataplicity_status[unit]
         location = values[1]
         remark = values[2]
-        cells = table.add_row().cells
-        if unit_status_platform == "online":
-            _set_cell_background(cells[1], "CEEDD0")
-        elif unit_status_platform == "offline":
-            _set_cell_background(cells[1], fill="F6CACF")
-        elif unit_status_platform == "partial":
-            _set_cell_background(cells[1], fill="FBEBA6")
-        elif unit_status_platform == "error":
-            _set_cell_background(cells[1], fill="FF0000")
-
-        if unit_status_dataplicity == "online":
-            _set_cell_background(cells[2], "CEEDD0")
-        elif unit_status_dataplicity == "offline":
-            _set_cell_background(cells[2], fill="F6CACF")
-        elif unit_status_platform == "partial":
-            _set_cell_background(cells[2], fill="FBEBA6")
-        cells[0].text = unit
-        cells[1].text = unit_status_platform
-        cells[2].text = unit_status_dataplicity
-        cells[3].text = location
-        cells[4].text = remark
+        report_rows.append((unit, unit_status_platform, unit_status_dataplicity, location, remark))
         # print(unit, values)
         statusDict[unit] = values[0]
+        status_counts[unit_status_platform] = status_counts.get(unit_status_platform, 0) + 1
+        history_rows.append((unit, unit_status_platform, unit_status_dataplicity, LAST_DATAPOINT_LATENCY.get(unit), remark))
     
     # rtn.append(statusDict)
-    table.style = "Table Grid"
-
-    document.save(OUTPUT_FILE)
+    report_formats.render(OUTPUT_FILE, system, report_rows, get_report_formats(formatted_time))
+    mark_phase("render")
     remove_data_dump()                                      # Remove all data dump files
+    mark_phase("dump cleanup")
     if not isBlockEmail:                                    # Block Email on initial start up
         if formatted_time == DAILY_EMAIL_TIME or formatted_time == VALIDATION_EMAIL_TIME:   # If it is doing full report
-            sendEmail(heading_cells[1].text, formatted_time)
-        checkUnitStatus(heading_cells[1].text, statusDict, formatted_time)                  # Check and compare unit status
-    StoreStatus(statusDict)                                 # Overwrite status, Always perform status check before overwritting
+            sendEmail(system, formatted_time)
+        # Adaptive checks between the hours only send the hourly email when a unit went offline or online
+        checkUnitStatus(system, statusDict, formatted_time, alwaysSend=formatted_time.endswith(":00"))
+    StoreStatus(system, formatted_time, history_rows)                                       # Always perform status check before storing
+    mark_phase("history")
+    mailer.flush()                                          # Emails are delivered from the outbox in the background
+    mark_phase("email")
+    PHASE_START = None
+    http_client.report_connection_stats()
+    retry.report_stats()
+    report_run_timing()
+    record_run_metrics(system, status_counts)
     # return rtn
 
+# Formats of the run's emails, the hourly and validation emails go to the IoT team, the daily email to everyone
+def get_report_formats(formatted_time):
+    formats = list(REPORT_FORMATS_IOT_TEAM)
+    if formatted_time == DAILY_EMAIL_TIME:
+        formats += [format for format in REPORT_FORMATS_EVERYONE if format not in formats]
+    return formats
+
+# Ends the current phase of the run's timing breakdown, the next phase starts now. Ignored outside generate_report.
+# CPU time is the whole process's, the gateway sweep's worker threads included.
+def mark_phase(phase):
+    global PHASE_START
+    if PHASE_START is None:
+        return
+    now = (time.monotonic(), time.process_time())
+    RUN_TIMING.append((phase, now[0] - PHASE_START[0], now[1] - PHASE_START[1]))
+    metrics.PHASE_SECONDS.observe(now[0] - PHASE_START[0], phase=phase)
+    PHASE_START = now
+
+def report_run_timing():
+    timing = ", ".join(phase + " " + str(round(seconds, 2)) + " s" for phase, seconds, cpu_seconds in RUN_TIMING)
+    # The emails are sent by the mailer thread after this line, it logs their SMTP time per run
+    log.info("Run timing: " + timing + " (" + str(mailer.get_queue_size()) + " email(s) in the outbox).")
+
+# Request latencies, phase durations, retries and emails are recorded as they happen, see metrics
+def record_run_metrics(system, status_counts):
+    for status, count in status_counts.items():
+        metrics.UNITS.set(count, system=system, status=status)
+    metrics.RUN_SECONDS.set(sum(seconds for phase, seconds, cpu_seconds in RUN_TIMING), system=system)
+    metrics.RUNS.inc(system=system)
+    metrics.LAST_RUN.set(time.time(), system=system)
+    metrics.flush()                                         # Rewrite the metrics file now rather than on the next interval
+
 # Check status of previous unit
-def checkUnitStatus(system, state, formatted_time):
-    jsonFile = open('data_dump/status.json')
-    unitPrevStatus = json.load(jsonFile)
+def checkUnitStatus(system, state, formatted_time, alwaysSend=True):
+    unitPrevStatus = status_store.get_previous_status()     # Statuses of the latest stored run
     offlineUnits = []
     onlineUnits = []
     for i in unitPrevStatus:
@@ -545,21 +1005,23 @@ def checkUnitStatus(system, state, formatted_time):
                 elif unitPrevStatus[i] != state[i] and state[i] == "online":
                     onlineUnits.append(i)
         except:
-            print("Error Occured")
+            log.exception("Error Occured")
     # if offlineUnits != []:
-    sendEmail(system, formatted_time, isHourly=True, OfflineDevice=offlineUnits, OnlineDevice=onlineUnits)
+    changed = bool(offlineUnits or onlineUnits)
+    if not changed and (not alwaysSend or HOURLY_SKIP_UNCHANGED):
+        log.info("No unit went offline or online, hourly email not sent.")
+        return
+    attach = HOURLY_ATTACHMENT == "always" or (HOURLY_ATTACHMENT == "changes" and changed)
+    sendEmail(system, formatted_time, isHourly=True, OfflineDevice=offlineUnits, OnlineDevice=onlineUnits, attach=attach)
 
-# Store current status
-def StoreStatus(statusDict):
-    json_string = json.dumps(statusDict, indent=4)
-    filename = "data_dump/status.json"
-    with open(filename, "w") as outfile:
-        outfile.write(json_string)
+# Store current status as a new run in the status history
+# rows: (unit, platform status, dataplicity status, latency of last datapoint in ms, remarks)
+def StoreStatus(system, formatted_time, rows):
+    status_store.store_run(system, formatted_time, rows)
 
 # Dynamic sendEmail, System refers to MADs or VFT.
 # Formatted time = hh:mm
-def sendEmail(System, formatted_time, isHourly=False, OfflineDevice=[], OnlineDevice=[]):
-    port = PORT # For SSL
+def sendEmail(System, formatted_time, isHourly=False, OfflineDevice=[], OnlineDevice=[], attach=True):
     message = MIMEMultipart()
     
     # If it is an hourly email, send basic,
@@ -569,12 +1031,17 @@ def sendEmail(System, formatted_time, isHourly=False, OfflineDevice=[], OnlineDe
     if isHourly:
         message['Subject'] = '(Alert) Hourly Status Report'
         message['To'] = ", ".join(RECIPIENTS_IOT_TEAM)                      # Change recipient here
+        formats = REPORT_FORMATS_IOT_TEAM
     elif formatted_time == DAILY_EMAIL_TIME:
         message['Subject'] = 'Daily Status Report'
         message['To'] = ", ".join(RECIPIENTS_EVERYONE)                      # Change recipient here
+        formats = REPORT_FORMATS_EVERYONE
     elif formatted_time == VALIDATION_EMAIL_TIME:
         message['Subject'] = '(Validation) Daily Status Report'
         message['To'] = ", ".join(RECIPIENTS_IOT_TEAM)                      # Change recipient here
+        formats = REPORT_FORMATS_IOT_TEAM
+    if not attach:                                                          # The hourly email may go without the report, see HOURLY_ATTACHMENT
+        formats = ()
         
     message['From'] = SENDER_EMAIL
 
@@ -582,17 +1049,24 @@ def sendEmail(System, formatted_time, isHourly=False, OfflineDevice=[], OnlineDe
         body = buildHourlyEmail(System, formatted_time, OfflineDevice, OnlineDevice)
     else:
         body = buildDailyEmail(System, formatted_time)
-    message.attach(MIMEText(body, 'plain'))
+    if "html" in formats:                                                   # HTML report goes inline, with the plain text as fallback
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText(body, 'plain'))
+        report_html = report_formats.read_report(report_formats.get_path(OUTPUT_FILE, "html")).decode("utf-8")
+        alternative.attach(MIMEText(report_formats.build_html_email(body, report_html), 'html'))
+        message.attach(alternative)
+    else:
+        message.attach(MIMEText(body, 'plain'))
 
-    with open(OUTPUT_FILE, 'rb') as attachment:
-        attachment = MIMEApplication(attachment.read(), _subtype='docx')
-        attachment.add_header('content-disposition', 'attachment', filename=OUTPUT_FILE)
+    for format in formats:
+        if format == "html":
+            continue
+        path = report_formats.get_path(OUTPUT_FILE, format)
+        attachment = MIMEApplication(report_formats.read_report(path), _subtype=report_formats.SUBTYPES[format])
+        attachment.add_header('content-disposition', 'attachment', filename=os.path.basename(path))
         message.attach(attachment)
     
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(SMTP_SERVER, port, context=context) as server:
-        server.login(SENDER_EMAIL, EMAIL_API_KEY)
-        server.sendmail(SENDER_EMAIL, message['To'].split(","), message.as_string())
+    mailer.queue(message.as_string(), message['To'].split(","), run=System + " " + formatted_time)    # Written to the outbox, sent by the mailer thread
 
 ### Craft and send email
 def buildDailyEmail(System, formatted_time):
@@ -652,42 +1126,36 @@ def buildHourlyEmail(System, formatted_time, OfflineDevice=[], OnlineDevice=[]):
     return body
 
 if __name__ == "__main__":
-    print("Starting Script...")
+    if len(sys.argv) > 1 and sys.argv[1] == "compile-config":
+        compile_configs()
+        sys.exit(0)
+    log.info("Starting Script...")
     isMADs = False
     generate_report(mads=isMADs, isBlockEmail=True)
-    validSend = True
-    while(1):
-        try:
-            currTime = datetime.datetime.now().strftime("%H:%M")
-            # currTime = "17:00"                                                # For debug only
-
-            mins = currTime.split(":")[1]
-            if currTime == DAILY_EMAIL_TIME and validSend:
-                print("==============================================")
-                print("Starting 1400 Status Check.")
-                print("==============================================")
-                generate_report(formatted_time=currTime, mads=isMADs)           #Generate report
-                validSend = False                                               #Flag to stop spam
-                print("==============================================")
-            elif currTime == VALIDATION_EMAIL_TIME and validSend:
-                print("==============================================")
-                print("Starting 1300 Status Validation Check.")
-                print("==============================================")
-                generate_report(formatted_time=currTime, mads=isMADs)           #Generate report
-                validSend = False                                               #Flag to stop spam
-                print("==============================================")
-            elif mins == "30" and not validSend:
-                print("==============================================")
-                print("Resetting Checks.")
-                validSend = True                                                #Reset generate report flag
-                print("==============================================")
-            elif mins == "00" and validSend:
-                print("==============================================")
-                print("Starting Hourly Check for", currTime, ".")
-                print("==============================================")
-                generate_report(formatted_time=currTime, mads=isMADs)           #Generate report
-                validSend = False                                               #Flag to stop spam
-                print("==============================================")
-            time.sleep(30)                                                      #Sleep for 30 seconds
-        except Exception as ex:
-            print(ex)
+    metrics.start()                                         # Settings are read from data_sheet by the first run
+
+    # Print the check's banner and generate its report, called by the scheduler with the slot time
+    def run_check(title):
+        def run(formatted_time):
+            log.info("==============================================")
+            log.info("Starting " + title.replace("{time}", formatted_time) + ".")
+            log.info("==============================================")
+            generate_report(formatted_time=formatted_time, mads=isMADs)      #Generate report
+            log.info("==============================================")
+        return run
+
+    # At 13:00 and 14:00 the validation / daily report replaces the hourly check
+    jobs = [
+        scheduler.Job("1400 Status Check", run_check("1400 Status Check"), at=DAILY_EMAIL_TIME, priority=2),
+        scheduler.Job("1300 Status Validation Check", run_check("1300 Status Validation Check"), at=VALIDATION_EMAIL_TIME, priority=1),
+    ]
+    if ADAPTIVE_POLLING and not isMADs:
+        jobs.append(scheduler.Job("Adaptive Check", run_check("Adaptive Check for {time}"), every_minutes=cadence.POLL_MINUTES))
+    else:
+        jobs.append(scheduler.Job("Hourly Check", run_check("Hourly Check for {time}"), every_minutes=60))
+    # Warm-ups give way to any report scheduled at the same time
+    if WARMUP_MINUTES > 0 and not isMADs:
+        for report_time in (VALIDATION_EMAIL_TIME, DAILY_EMAIL_TIME):
+            warmup_time = (datetime.datetime.strptime(report_time, "%H:%M") - datetime.timedelta(minutes=WARMUP_MINUTES)).strftime("%H:%M")
+            jobs.append(scheduler.Job("Warm-up for " + report_time, warm_up_gateways, at=warmup_time, priority=-1, catch_up_minutes=WARMUP_MINUTES // 2))
+    scheduler.Scheduler(jobs).run_forever()